@@ -1,21 +1,29 @@
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from contextlib import asynccontextmanager
 import uvicorn
 import logging
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, Callable, Awaitable, Iterator
 import paho.mqtt.client as mqtt
-import json
 import os
+import math
+import re
+import socket
+import time
+import orjson
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
-from datetime import datetime
+from pydantic import BaseModel, Field, TypeAdapter
+from datetime import datetime, timedelta
 from enum import Enum
+from dataclasses import asdict, dataclass, field, fields
+from functools import lru_cache
+from operator import attrgetter
 from typing import Dict, List, Optional
 from pathlib import Path
 import hashlib
-import requests
-from dateutil import parser as dateutil_parser  # type: ignore
+import httpx
+from cachetools import LRUCache, TTLCache
 
 """
 Database imports: handle both package and direct execution contexts.
@@ -24,14 +32,14 @@ try:
     # When running with project root in PYTHONPATH
     from server.database.init import init_db, db_health_check
     from server.database.engine import get_session
-    from server.database.engine import AsyncSessionLocal
+    from server.database.engine import AsyncSessionLocal, create_pg_pool
     from server.database.repositories import (
         upsert_device,
         log_device_boot,
-        record_sensor_reading,
+        record_sensor_readings,
         create_sos_incident,
         get_weather_history,
-        create_device_log,
+        record_device_logs,
         get_device_logs,
         get_device_crash_logs,
     )
@@ -41,246 +49,319 @@ except Exception:
     sys.path.append(os.path.dirname(os.path.dirname(__file__)))
     from database.init import init_db, db_health_check  # type: ignore
     from database.engine import get_session  # type: ignore
-    from database.engine import AsyncSessionLocal  # type: ignore
+    from database.engine import AsyncSessionLocal, create_pg_pool  # type: ignore
     from database.repositories import (  # type: ignore
         upsert_device,
         log_device_boot,
-        record_sensor_reading,
+        record_sensor_readings,
         create_sos_incident,
         get_weather_history,
-        create_device_log,
+        record_device_logs,
         get_device_logs,
         get_device_crash_logs,
     )
 
 # Async utilities
 import asyncio
+import heapq
+import itertools
+import contextlib
 
-# Global handle to the running event loop for scheduling DB work from MQTT thread
+# Global handle to the running event loop; the paho thread hands every message to it
 _event_loop: Optional[asyncio.AbstractEventLoop] = None
 
+# Set by _ingest_mqtt whenever it adds DB work to _db_pending (see _drain_db_pending)
+_db_pending_wake: Optional[asyncio.Event] = None
+# Set at shutdown: the writer flushes whatever is still pending, then returns
+_db_writer_stopping = False
+
+# Broker connection flag kept by on_connect/on_disconnect, so request handlers read a
+# module global instead of taking paho's lock or going through app.state's __getattr__
+_mqtt_connected = False
+# put_nowait of the MQTT outbox, bound at startup: _mqtt_send((topic, payload_bytes))
+_mqtt_send: Optional[Callable[[Tuple[str, bytes]], None]] = None
+
+
+# Frames buffered per websocket client; when a slow client falls this far behind,
+# its oldest pending frame is dropped
+WS_CLIENT_QUEUE_SIZE = 256
 
 # WebSocket connection manager for real-time updates
 class ConnectionManager:
-    """Manages WebSocket connections for broadcasting state updates."""
+    """Manages WebSocket connections for broadcasting state updates.
+
+    Each client gets its own bounded queue drained by a pump task, so a slow socket
+    only ever delays itself.
+    """
 
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: Dict[WebSocket, Tuple[asyncio.Queue, asyncio.Task]] = {}
+        # Last frame sent per message type; devices republish unchanged status as a heartbeat
+        self._last_sent: Dict[str, str] = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=WS_CLIENT_QUEUE_SIZE)
+        pump = asyncio.create_task(self._pump(websocket, queue))
+        self.active_connections[websocket] = (queue, pump)
+        # Let the next update of every type through so the new client sees it
+        self._last_sent.clear()
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        entry = self.active_connections.pop(websocket, None)
+        if entry is not None and entry[1] is not asyncio.current_task():
+            entry[1].cancel()
 
-    async def broadcast(self, message: dict):
-        for conn in self.active_connections[:]:  # Copy list to avoid mutation during iteration
+    async def _pump(self, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True:
+                await websocket.send_text(await queue.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(websocket)
+
+    def broadcast(self, message: dict):
+        """Queue a message for every client without waiting on any socket (loop thread only)."""
+        if not self.active_connections:
+            return
+        # Encode once for all clients; text frames because the app client JSON.parse()s event.data
+        text = orjson.dumps(message).decode()
+        update_type = message.get("type")
+        if self._last_sent.get(update_type) == text:
+            return
+        self._last_sent[update_type] = text
+        for queue, _ in self.active_connections.values():
             try:
-                await conn.send_json(message)
-            except Exception:
-                self.disconnect(conn)
+                queue.put_nowait(text)
+            except asyncio.QueueFull:
+                queue.get_nowait()
+                queue.put_nowait(text)
 
 
 ws_manager = ConnectionManager()
 
 
 def broadcast_state_update(update_type: str, data: dict):
-    """Schedule a websocket broadcast from sync MQTT callback context."""
-    if _event_loop is not None:
-        asyncio.run_coroutine_threadsafe(
-            ws_manager.broadcast({"type": update_type, "data": data}),
-            _event_loop
-        )
+    """Queue a websocket broadcast; MQTT handlers already run on the event loop."""
+    ws_manager.broadcast({"type": update_type, "data": data})
 
 
-async def process_mqtt_event(topic: str, payload: str) -> None:
-    """Persist relevant MQTT events into the database.
+# Repeated health/version payloads only rewrite the devices row after this many seconds
+DEVICE_UPSERT_DEBOUNCE_S = 30.0
+# (device_id, msg_type) -> (payload, monotonic time of last upsert)
+_last_pushed: Dict[Tuple[str, str], Tuple[bytes, float]] = {}
 
-    Args:
-        topic (str): MQTT topic
-        payload (str): Decoded payload
+
+def _should_push(device_id: str, msg_type: str, payload: bytes) -> bool:
+    """Return False if the same payload was written for this device recently."""
+    key = (device_id, msg_type)
+    now = time.monotonic()
+    prev = _last_pushed.get(key)
+    if prev is not None and prev[0] == payload and now - prev[1] < DEVICE_UPSERT_DEBOUNCE_S:
+        return False
+    _last_pushed[key] = (payload, now)
+    return True
+
+
+# Consolidated-status heartbeats repeat unchanged readings; see _DbBatch.reading_if_changed
+SENSOR_FLOAT_TOLERANCE = 0.01
+SENSOR_REPEAT_MAX_AGE_S = 60.0
+# Width of sensor_readings.value_text
+SENSOR_VALUE_TEXT_MAX = 64
+# (device_id, metric) -> (last recorded value, monotonic time it was recorded)
+_last_sensor: Dict[Tuple[str, str], Tuple[Any, float]] = {}
+
+
+class _DbBatch:
+    """DB work produced by the MQTT handlers since the writer's last flush.
+
+    Device-event writes are kept as (persist coroutine, device_id, parsed value, timestamp)
+    and run in arrival order; device-existence upserts, sensor rows and device logs follow in bulk.
     """
+
+    __slots__ = ("ops", "readings", "logs", "ensure_devices")
+
+    def __init__(self):
+        self.ops: List[Tuple[Callable[..., Awaitable[None]], str, Any, datetime]] = []
+        # Tuples in SENSOR_READING_COPY_COLUMNS order, ready for record_sensor_readings
+        self.readings: List[tuple] = []
+        # Tuples in DEVICE_LOG_COPY_COLUMNS order, ready for record_device_logs
+        self.logs: List[tuple] = []
+        self.ensure_devices: set[str] = set()
+
+    def op(self, persist: Callable[..., Awaitable[None]], device_id: str, value: Any, now: datetime) -> None:
+        self.ops.append((persist, device_id, value, now))
+
+    def reading_if_changed(self, device_id: str, metric: str, recorded_at: datetime,
+                           value_float: Optional[float] = None, value_text: Optional[str] = None) -> None:
+        """Like reading(), but drop a heartbeat repeat of the metric's last recorded value.
+
+        Floats within SENSOR_FLOAT_TOLERANCE count as unchanged. A repeat is still written once
+        SENSOR_REPEAT_MAX_AGE_S has passed, so steady values keep filling history buckets.
+        """
+        key = (device_id, metric)
+        value = value_text if value_float is None else value_float
+        now = time.monotonic()
+        prev = _last_sensor.get(key)
+        if prev is not None and now - prev[1] < SENSOR_REPEAT_MAX_AGE_S:
+            prev_value = prev[0]
+            if prev_value == value or (
+                value_float is not None and isinstance(prev_value, float)
+                and abs(prev_value - value_float) < SENSOR_FLOAT_TOLERANCE
+            ):
+                return
+        _last_sensor[key] = (value, now)
+        self.reading(device_id, metric, recorded_at, value_float=value_float, value_text=value_text)
+
+    def reading(self, device_id: str, metric: str, recorded_at: datetime,
+                value_float: Optional[float] = None, value_text: Optional[str] = None) -> None:
+        # One row the table rejects fails the whole COPY: keep value_text a str within String(64)
+        if value_text is not None:
+            value_text = str(value_text)[:SENSOR_VALUE_TEXT_MAX]
+        # The receive time doubles as the row's created_at/updated_at
+        self.readings.append((device_id, metric, value_float, value_text, recorded_at, recorded_at, recorded_at))
+
+
+# Filled by the MQTT handlers on the loop; _drain_db_pending swaps in a fresh batch per flush
+_db_pending = _DbBatch()
+
+
+async def _persist_system_health(session, device_id: str, payload: bytes, now: datetime) -> None:
+    if _should_push(device_id, 'health', payload):
+        await upsert_device(session, device_id=device_id, status=payload.decode())
+
+
+async def _persist_system_sos(session, device_id: str, details: dict, now: datetime) -> None:
+    # Status is overwritten below; the next health ping must be written through
+    _last_pushed.pop((device_id, 'health'), None)
+    await upsert_device(
+        session,
+        device_id=device_id,
+        status=DeviceStatus.NEEDS_HELP.value,
+        last_error=details.get('message') or details.get('error') or 'Unknown error',
+    )
+    await create_sos_incident(
+        session,
+        device_id=device_id,
+        error_message=details.get('message') or details.get('error'),
+        details=details,
+    )
+
+
+async def _persist_system_boot(session, device_id: str, boot_dt: datetime, now: datetime) -> None:
+    await upsert_device(session, device_id=device_id, last_boot=boot_dt)
+    await log_device_boot(session, device_id=device_id, boot_time=boot_dt)
+
+
+async def _persist_system_version(session, device_id: str, payload: bytes, now: datetime) -> None:
+    if _should_push(device_id, 'version', payload):
+        await upsert_device(session, device_id=device_id, version=payload.decode())
+
+
+async def _flush_db_batch(session, batch: _DbBatch) -> None:
+    """Run a batch's device-event writes in order, then its device upserts and one COPY per table."""
+    for persist, device_id, value, now in batch.ops:
+        try:
+            await persist(session, device_id, value, now)
+        except Exception as ex:
+            logger.error("%s failed for device %s: %s", persist.__name__, device_id, ex)
+            # The session is shared with the rest of the batch; clear any failed transaction
+            with contextlib.suppress(Exception):
+                await session.rollback()
+    if not (batch.readings or batch.logs or batch.ensure_devices):
+        return
+    # Each upsert in its own try so one bad device cannot take the batch's readings down with it
+    for device_id in batch.ensure_devices:
+        try:
+            await upsert_device(session, device_id=device_id)
+        except Exception as ex:
+            logger.error("Failed to upsert device %s: %s", device_id, ex)
+            with contextlib.suppress(Exception):
+                await session.rollback()
+    # A row the table rejects is retried away by the COPY helpers and costs only itself;
+    # anything raised here (e.g. connection loss) still loses that table's batch
     try:
-        async with AsyncSessionLocal() as session:  # type: ignore
-            # System topics: home/system/{device_id}/{type}
-            if topic.startswith("home/system/"):
-                parts = topic.split('/')
-                if len(parts) >= 4:
-                    device_id = parts[2]
-                    msg_type = parts[3]
-
-                    if msg_type == 'health':
-                        await upsert_device(session, device_id=device_id, status=payload)
-                    elif msg_type == 'sos':
-                        details = json.loads(payload) if payload else {}
-                        await upsert_device(
-                            session,
-                            device_id=device_id,
-                            status=DeviceStatus.NEEDS_HELP.value,
-                            last_error=details.get('message') or details.get('error') or 'Unknown error',
-                        )
-                        await create_sos_incident(
-                            session,
-                            device_id=device_id,
-                            error_message=details.get('message') or details.get('error'),
-                            details=details,
-                        )
-                    elif msg_type == 'boot':
-                        try:
-                            boot_dt = datetime.utcfromtimestamp(int(payload) / 1000)
-                        except Exception:
-                            boot_dt = datetime.utcnow()
-                        await upsert_device(session, device_id=device_id, last_boot=boot_dt)
-                        await log_device_boot(session, device_id=device_id, boot_time=boot_dt)
-                    elif msg_type == 'version':
-                        await upsert_device(session, device_id=device_id, version=payload)
-                    elif msg_type == 'log':
-                        # Handle device logs: home/system/{device_id}/log
-                        try:
-                            log_data = json.loads(payload) if payload else {}
-                            await create_device_log(
-                                session,
-                                device_id=device_id,
-                                level=log_data.get('level', 'INFO'),
-                                component=log_data.get('component', 'unknown'),
-                                message=log_data.get('message', ''),
-                                details=log_data.get('details'),
-                                device_timestamp=log_data.get('timestamp'),
-                                sequence=log_data.get('sequence'),
-                            )
-                        except Exception as e:
-                            logger.warning(f"Failed to process device log from {device_id}: {e}")
-
-            # Garage and other topics → record as sensor readings
-            elif topic == GARAGE_LIGHT_TOPIC:
-                await record_sensor_reading(session, device_id=GARAGE_DEVICE_ID, metric='garage_light', value_text=payload)
-            elif topic == GARAGE_DOOR_STATUS_TOPIC:
-                await record_sensor_reading(session, device_id=GARAGE_DEVICE_ID, metric='garage_door', value_text=payload)
-            # Weather station topics (from dedicated weather-station device)
-            elif topic == WEATHER_STATION_WEATHER_TEMP_TOPIC:
-                try:
-                    await record_sensor_reading(session, device_id=WEATHER_STATION_DEVICE_ID, metric='weather_temperature_f', value_float=float(payload))
-                except Exception:
-                    pass
-            elif topic == WEATHER_STATION_WEATHER_PRESSURE_TOPIC:
-                try:
-                    await record_sensor_reading(session, device_id=WEATHER_STATION_DEVICE_ID, metric='weather_pressure_inhg', value_float=float(payload))
-                except Exception:
-                    pass
-
-            # House monitor consolidated status - record sensor readings
-            elif topic == HOUSE_MONITOR_STATUS_TOPIC:
-                try:
-                    data = json.loads(payload) if payload else {}
-                    # Ensure device exists
-                    await upsert_device(session, device_id=HOUSE_MONITOR_DEVICE_ID)
-
-                    # Record city power status
-                    city_power = data.get('power', {}).get('city')
-                    if city_power:
-                        await record_sensor_reading(
-                            session,
-                            device_id=HOUSE_MONITOR_DEVICE_ID,
-                            metric='city_power',
-                            value_text=city_power
-                        )
-
-                    # Record freezer temperature
-                    freezer_temp = data.get('freezer', {}).get('temperature_f')
-                    if freezer_temp is not None:
-                        await record_sensor_reading(
-                            session,
-                            device_id=HOUSE_MONITOR_DEVICE_ID,
-                            metric='house_freezer_temperature_f',
-                            value_float=float(freezer_temp)
-                        )
-
-                    # Record freezer door status
-                    freezer_door = data.get('freezer', {}).get('door')
-                    if freezer_door:
-                        await record_sensor_reading(
-                            session,
-                            device_id=HOUSE_MONITOR_DEVICE_ID,
-                            metric='house_freezer_door',
-                            value_text=freezer_door
-                        )
-
-                    # Record door ajar time if door is open
-                    door_ajar_s = data.get('freezer', {}).get('door_ajar_s')
-                    if door_ajar_s is not None and door_ajar_s > 0:
-                        await record_sensor_reading(
-                            session,
-                            device_id=HOUSE_MONITOR_DEVICE_ID,
-                            metric='house_freezer_door_ajar_s',
-                            value_float=float(door_ajar_s)
-                        )
-
-                except Exception as e:
-                    logger.warning(f"Failed to persist house-monitor status: {e}")
-
-            # Garage controller consolidated status - record sensor readings
-            elif topic == GARAGE_CONTROLLER_STATUS_TOPIC:
-                try:
-                    data = json.loads(payload) if payload else {}
-                    # Ensure device exists
-                    await upsert_device(session, device_id=GARAGE_DEVICE_ID)
-
-                    # Record door state
-                    door_state_val = data.get('door', {}).get('state')
-                    if door_state_val:
-                        await record_sensor_reading(
-                            session,
-                            device_id=GARAGE_DEVICE_ID,
-                            metric='garage_door',
-                            value_text=door_state_val
-                        )
-
-                    # Record light state
-                    light_state_val = data.get('light', {}).get('state')
-                    if light_state_val:
-                        await record_sensor_reading(
-                            session,
-                            device_id=GARAGE_DEVICE_ID,
-                            metric='garage_light',
-                            value_text=light_state_val
-                        )
-
-                except Exception as e:
-                    logger.warning(f"Failed to persist garage-controller status: {e}")
-
-            # Weather station consolidated status - record sensor readings
-            elif topic == WEATHER_STATION_STATUS_TOPIC:
-                try:
-                    data = json.loads(payload) if payload else {}
-                    # Ensure device exists
-                    await upsert_device(session, device_id=WEATHER_STATION_DEVICE_ID)
-
-                    # Record weather temperature
-                    weather_temp = data.get('weather', {}).get('temperature_f')
-                    if weather_temp is not None:
-                        await record_sensor_reading(
-                            session,
-                            device_id=WEATHER_STATION_DEVICE_ID,
-                            metric='weather_temperature_f',
-                            value_float=float(weather_temp)
-                        )
-
-                    # Record weather pressure
-                    weather_pressure = data.get('weather', {}).get('pressure_inhg')
-                    if weather_pressure is not None:
-                        await record_sensor_reading(
-                            session,
-                            device_id=WEATHER_STATION_DEVICE_ID,
-                            metric='weather_pressure_inhg',
-                            value_float=float(weather_pressure)
-                        )
-
-                except Exception as e:
-                    logger.warning(f"Failed to persist weather-station status: {e}")
+        rejected = await record_sensor_readings(session, batch.readings)
+        if rejected:
+            logger.error("Dropped %d of %d sensor readings rejected by the database", len(rejected), len(batch.readings))
     except Exception as ex:
-        logger.error(f"process_mqtt_event failed for topic={topic}: {ex}")
+        logger.error("Failed to flush %d sensor readings: %s", len(batch.readings), ex)
+        with contextlib.suppress(Exception):
+            await session.rollback()
+        rejected = batch.readings
+    # reading_if_changed noted these values when they were queued; forget them so the next
+    # identical value is written instead of being suppressed as unchanged
+    for record in rejected:
+        _last_sensor.pop((record[0], record[1]), None)
+    try:
+        rejected = await record_device_logs(session, batch.logs)
+        if rejected:
+            logger.error("Dropped %d of %d device logs rejected by the database", len(rejected), len(batch.logs))
+    except Exception as ex:
+        logger.error("Failed to flush %d device logs: %s", len(batch.logs), ex)
+        with contextlib.suppress(Exception):
+            await session.rollback()
+
+# How long the writer lingers after a wake-up so a burst of MQTT traffic lands in one
+# flush instead of one per message
+DB_FLUSH_LINGER_S = 0.05
+# Upper bound on the final flush at shutdown
+DB_SHUTDOWN_FLUSH_TIMEOUT_S = 10.0
+
+async def _drain_db_pending() -> None:
+    """Persist the DB work queued by the MQTT handlers, in arrival order; runs for the app lifetime."""
+    global _db_pending
+    wake = _db_pending_wake
+    # One session for the writer's lifetime; it returns its connection to the pool
+    # after each commit, so holding it between batches costs nothing
+    async with AsyncSessionLocal() as session:  # type: ignore
+        while True:
+            await wake.wait()
+            if not _db_writer_stopping:
+                await asyncio.sleep(DB_FLUSH_LINGER_S)
+            wake.clear()
+            # Swap rather than drain: handlers keep filling the fresh batch during the flush
+            batch, _db_pending = _db_pending, _DbBatch()
+            try:
+                await _flush_db_batch(session, batch)
+            except Exception as ex:
+                logger.error("MQTT DB writer failed: %s", ex)
+            # Keep going while work arrived during the flush; the stop request sets wake too
+            if _db_writer_stopping and not wake.is_set():
+                return
+
+MQTT_PUBLISH_BATCH = 32
+
+def publish_batch(client: mqtt.Client, messages: List[Tuple[str, bytes]]) -> None:
+    """Publish messages back-to-back, in order, on the calling thread."""
+    for topic, payload in messages:
+        try:
+            # Explicit QoS 0, not retained: best-effort commands, the HTTP caller already has its answer
+            client.publish(topic, payload, 0, False)
+        except Exception as e:
+            logger.error("Failed to publish to %s: %s", topic, e)
+
+async def _drain_mqtt_outbox(client: mqtt.Client, outbox: "asyncio.Queue[Optional[Tuple[str, bytes]]]") -> None:
+    """Publish queued commands in order off the event loop; runs for the app lifetime.
+
+    Whatever queued up while the previous batch was publishing (up to MQTT_PUBLISH_BATCH)
+    goes out in one executor hop. Messages are never merged: commands like the door
+    'toggle' are not idempotent. A None queued at shutdown, behind every real command,
+    makes it return once everything before it is published.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await outbox.get()]
+        while len(batch) < MQTT_PUBLISH_BATCH and not outbox.empty():
+            batch.append(outbox.get_nowait())
+        stop = batch[-1] is None
+        if stop:
+            batch.pop()
+        if batch:
+            await loop.run_in_executor(None, publish_batch, client, batch)
+        if stop:
+            return
 
 # Load environment variables
 load_dotenv()
@@ -289,25 +370,6 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# MQTT Settings
-# Use 'mqtt' when running in Docker, 'localhost' when running locally
-MQTT_BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "localhost")
-MQTT_BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", 1883))
-MQTT_USERNAME = os.getenv("MQTT_USERNAME", "")
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", "")
-
-# Associate garage-originated readings with this device_id (must exist in devices table)
-# Override via env GARAGE_DEVICE_ID if your device_id differs (e.g., 'garage-controller')
-GARAGE_DEVICE_ID = os.getenv("GARAGE_DEVICE_ID", "garage-controller")
-
-# OTA Repo Settings
-# If OTA_RAW_BASE is set, it should include the trailing ref or path prefix as needed.
-# Otherwise, we build raw GitHub URLs using ORG/REPO and ref.
-OTA_RAW_BASE = os.getenv("OTA_RAW_BASE", "").rstrip("/")  # e.g., https://your-server/ota/raw
-GITHUB_ORG = os.getenv("GITHUB_ORG", "")
-GITHUB_REPO = os.getenv("GITHUB_REPO", "")
-GITHUB_DEFAULT_REF = os.getenv("GITHUB_DEFAULT_REF", "main")
-
 # Repository root resolution
 def _resolve_project_root() -> Path:
     """Resolve the monorepo root path.
@@ -338,8 +400,75 @@ def _resolve_project_root() -> Path:
     except Exception:
         return here.parent
 
-PROJECT_ROOT = _resolve_project_root()
-logger.debug(f"Resolved PROJECT_ROOT to {PROJECT_ROOT}")
+
+@dataclass(frozen=True)
+class Settings:
+    """Server configuration, read from the environment once at startup.
+
+    Attributes:
+        mqtt_broker_host: Broker host ('mqtt' in Docker, 'localhost' locally).
+        mqtt_broker_port: Broker port.
+        mqtt_username: Broker username (auth is skipped when empty).
+        mqtt_password: Broker password.
+        garage_device_id: device_id for garage-originated readings (must exist in devices table).
+        house_monitor_device_id: device_id of the house-monitor.
+        weather_station_device_id: device_id of the weather-station.
+        ota_raw_base: Base URL serving /<ref>/<path> raw files; overrides GitHub when set.
+        github_org: GitHub org used to build raw URLs.
+        github_repo: GitHub repo used to build raw URLs.
+        github_default_ref: Ref used when an OTA request does not specify one.
+        ota_include_sha256: Include sha256 validators in OTA manifests. Off until
+            server/device hash consistency is fixed; while off, content is not hashed.
+        project_root: Monorepo root containing devices/ and shared/.
+    """
+    mqtt_broker_host: str
+    mqtt_broker_port: int
+    mqtt_username: str
+    mqtt_password: str
+    garage_device_id: str
+    house_monitor_device_id: str
+    weather_station_device_id: str
+    ota_raw_base: str
+    github_org: str
+    github_repo: str
+    github_default_ref: str
+    ota_include_sha256: bool
+    project_root: Path
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """Build settings from environment variables (after .env is loaded)."""
+        return cls(
+            mqtt_broker_host=os.getenv("MQTT_BROKER_HOST", "localhost"),
+            mqtt_broker_port=int(os.getenv("MQTT_BROKER_PORT", 1883)),
+            mqtt_username=os.getenv("MQTT_USERNAME", ""),
+            mqtt_password=os.getenv("MQTT_PASSWORD", ""),
+            garage_device_id=os.getenv("GARAGE_DEVICE_ID", "garage-controller"),
+            house_monitor_device_id=os.getenv("HOUSE_MONITOR_DEVICE_ID", "house-monitor"),
+            weather_station_device_id=os.getenv("WEATHER_STATION_DEVICE_ID", "weather-station"),
+            ota_raw_base=os.getenv("OTA_RAW_BASE", "").rstrip("/"),  # e.g., https://your-server/ota/raw
+            github_org=os.getenv("GITHUB_ORG", ""),
+            github_repo=os.getenv("GITHUB_REPO", ""),
+            github_default_ref=os.getenv("GITHUB_DEFAULT_REF", "main"),
+            ota_include_sha256=os.getenv("OTA_INCLUDE_SHA256", "false").lower() in ("1", "true", "yes"),
+            project_root=_resolve_project_root(),
+        )
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Return the process-wide settings, loading them on first use."""
+    return Settings.from_env()
+
+
+settings = get_settings()
+
+# Associate garage-originated readings with this device_id
+# Override via env GARAGE_DEVICE_ID if your device_id differs (e.g., 'garage-controller')
+GARAGE_DEVICE_ID = settings.garage_device_id
+
+PROJECT_ROOT = settings.project_root
+logger.debug("Resolved PROJECT_ROOT to %s", PROJECT_ROOT)
 
 # Device Status Models
 class DeviceStatus(str, Enum):
@@ -349,6 +478,9 @@ class DeviceStatus(str, Enum):
     UPDATING = "updating"
     ERROR = "error"
 
+# Raw health payload -> status; skips the enum's value lookup (and its ValueError) per message
+_STATUS_LOOKUP: Dict[bytes, DeviceStatus] = {s.value.encode(): s for s in DeviceStatus}
+
 class DeviceInfo(BaseModel):
     device_id: str
     status: DeviceStatus = DeviceStatus.OFFLINE
@@ -360,8 +492,34 @@ class DeviceInfo(BaseModel):
     rssi: Optional[int] = None  # WiFi signal strength
     last_error_code: Optional[str] = None
 
+
+@dataclass(slots=True)
+class DeviceInfoData:
+    """In-memory registry entry mirroring DeviceInfo.
+
+    Kept as a plain dataclass so MQTT-driven updates are bare attribute writes;
+    converted to DeviceInfo only at the HTTP boundary (see _device_info).
+    """
+    device_id: str
+    status: DeviceStatus = DeviceStatus.OFFLINE
+    last_seen: Optional[datetime] = None
+    version: Optional[str] = None
+    last_error: Optional[str] = None
+    last_boot: Optional[datetime] = None
+    ip_address: Optional[str] = None
+    rssi: Optional[int] = None
+    last_error_code: Optional[str] = None
+
+
+_DEVICE_FIELDS = frozenset(f.name for f in fields(DeviceInfoData))
+
 # In-memory device registry
-device_registry: Dict[str, DeviceInfo] = {}
+device_registry: Dict[str, DeviceInfoData] = {}
+
+
+def _device_info(device: DeviceInfoData) -> DeviceInfo:
+    """Build the response model from a registry entry without re-validating it."""
+    return DeviceInfo.model_construct(**asdict(device))
 
 class AlertItem(BaseModel):
     """Structured current alert for a device.
@@ -377,18 +535,69 @@ class AlertItem(BaseModel):
     message: Optional[str] = None
     last_seen: datetime
 
-# Map of (device_id, code) -> latest AlertItem
-current_alerts: Dict[tuple[str, str], AlertItem] = {}
 
-def update_device_status(device_id: str, **updates) -> DeviceInfo:
-    """Update device status in the registry."""
-    now = datetime.utcnow()
-    if device_id not in device_registry:
-        device_registry[device_id] = DeviceInfo(device_id=device_id, last_seen=now)
-    
-    device = device_registry[device_id]
+@dataclass(slots=True)
+class AlertItemData:
+    """In-memory alert entry mirroring AlertItem; refreshed in place by record_alert."""
+    device_id: str
+    code: str
+    message: Optional[str]
+    last_seen: datetime
+
+# Cap on tracked codes per device: a device flooding unique SOS messages
+# evicts its own least recently seen codes instead of growing without bound.
+MAX_ALERTS_PER_DEVICE = 32
+
+# device_id -> {code -> latest alert}; each inner dict in least-recently-seen order
+current_alerts: Dict[str, Dict[str, AlertItemData]] = {}
+# Bumped on every mutation of current_alerts; keys the serialized /api/alerts/current body
+_alerts_version = 0
+_alerts_bodies_version = -1
+_alerts_bodies: Dict[Optional[int], bytes] = {}  # limit -> encoded body at _alerts_bodies_version
+_MAX_CACHED_ALERT_BODIES = 8
+# Serializes the alert list in pydantic-core (Rust) without a model_dump() dict per item
+_ALERTS_TA = TypeAdapter(List[AlertItemData])
+
+def record_alert(device_id: str, code: str, message: Optional[str], now: datetime) -> None:
+    """Insert or refresh the (device_id, code) alert, enforcing MAX_ALERTS_PER_DEVICE."""
+    global _alerts_version
+    _alerts_version += 1
+    device_alerts = current_alerts.get(device_id)
+    if device_alerts is None:
+        device_alerts = current_alerts[device_id] = {}
+    item = device_alerts.pop(code, None)
+    if item is not None:
+        # Repeated code: refresh in place rather than building a new entry
+        item.message = message
+        item.last_seen = now
+    else:
+        if len(device_alerts) >= MAX_ALERTS_PER_DEVICE:
+            # Dict order is recency order, so the first key is the device's oldest code
+            del device_alerts[next(iter(device_alerts))]
+        item = AlertItemData(device_id, code, message, now)
+    # (Re)insert at the end to mark as most recently seen
+    device_alerts[code] = item
+
+def _utc_from_ns(ns: Optional[int]) -> Optional[datetime]:
+    """Convert a time.time_ns() stamp to a naive UTC datetime."""
+    return datetime.utcfromtimestamp(ns / 1e9) if ns is not None else None
+
+def update_device_status(device_id: str, now: Optional[datetime] = None, **updates) -> DeviceInfoData:
+    """Update device status in the registry.
+
+    Args:
+        device_id (str): Device to update (created on first sight).
+        now (datetime | None): Callback timestamp to record as last_seen; defaults to utcnow.
+        **updates: DeviceInfoData fields to set.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    device = device_registry.get(device_id)
+    if device is None:
+        device = device_registry[device_id] = DeviceInfoData(device_id=device_id)
+
     for key, value in updates.items():
-        if hasattr(device, key):
+        if key in _DEVICE_FIELDS:
             setattr(device, key, value)
     
     # Always update last seen on any update
@@ -396,6 +605,8 @@ def update_device_status(device_id: str, **updates) -> DeviceInfo:
     return device
 
 # MQTT Topics (matching Pico W implementation)
+SYSTEM_TOPIC_PREFIX = 'home/system/'  # home/system/<device_id>/<type>
+_SYSTEM_PREFIX_LEN = len(SYSTEM_TOPIC_PREFIX)
 # GARAGE_DEVICE_ID is configured above; do not override here.
 GARAGE_LIGHT_TOPIC = 'home/garage/light/status'  # From Pico W to server
 GARAGE_LIGHT_COMMAND_TOPIC = 'home/garage/light/command'  # From server to Pico W
@@ -406,11 +617,11 @@ GARAGE_WEATHER_PRESSURE_TOPIC = 'home/garage/weather/pressure'
 GARAGE_FREEZER_TEMPERATURE_TOPIC = 'home/garage/freezer/temperature'
 
 # House Monitor Topics
-HOUSE_MONITOR_DEVICE_ID = os.getenv("HOUSE_MONITOR_DEVICE_ID", "house-monitor")
+HOUSE_MONITOR_DEVICE_ID = settings.house_monitor_device_id
 HOUSE_MONITOR_STATUS_TOPIC = 'home/house-monitor/status'
 
 # Weather Station Topics (BMP388 weather + DS18B20 outdoor temperature)
-WEATHER_STATION_DEVICE_ID = os.getenv("WEATHER_STATION_DEVICE_ID", "weather-station")
+WEATHER_STATION_DEVICE_ID = settings.weather_station_device_id
 WEATHER_STATION_STATUS_TOPIC = 'home/weather-station/status'
 WEATHER_STATION_WEATHER_TEMP_TOPIC = 'home/weather-station/weather/temperature'
 WEATHER_STATION_WEATHER_PRESSURE_TOPIC = 'home/weather-station/weather/pressure'
@@ -423,10 +634,8 @@ class LightState(BaseModel):
     state: str  # 'on' or 'off'
     last_updated: Optional[str] = None
 
-# In-memory storage for light state (in production, use a database)
-garage_light_state = LightState(state="off")
 
-# Additional in-memory sensor caches
+# Sensor state response models
 class WeatherState(BaseModel):
     temperature_f: Optional[float] = None
     pressure_inhg: Optional[float] = None
@@ -443,6 +652,38 @@ class DoorState(BaseModel):
     last_updated: Optional[datetime] = None
 
 
+# In-memory state caches. Plain slotted dataclasses so MQTT updates are bare
+# attribute writes; the response models above are built only when served.
+# Per-message sensor caches record time.time_ns() and convert on the way out.
+@dataclass(slots=True)
+class LightStateData:
+    state: str = "off"  # 'on' or 'off'
+    last_updated: Optional[str] = None
+
+
+@dataclass(slots=True)
+class WeatherStateData:
+    temperature_f: Optional[float] = None
+    pressure_inhg: Optional[float] = None
+    last_updated_ns: Optional[int] = None
+
+
+@dataclass(slots=True)
+class FreezerStateData:
+    temperature_f: Optional[float] = None
+    last_updated_ns: Optional[int] = None
+
+
+@dataclass(slots=True)
+class DoorStateData:
+    state: Optional[str] = None
+    last_updated_ns: Optional[int] = None
+
+
+# In-memory storage for light state (in production, use a database)
+garage_light_state = LightStateData()
+
+
 class HouseMonitorState(BaseModel):
     """Consolidated state from house-monitor device.
 
@@ -479,11 +720,64 @@ class GarageControllerState(BaseModel):
     last_updated: Optional[datetime] = None
 
 
-weather_state = WeatherState()
-freezer_state = FreezerState()
-door_state = DoorState()
-house_monitor_state = HouseMonitorState()
-garage_controller_state = GarageControllerState()
+# In-memory consolidated state, mutated per status message; timestamps stay as
+# time.time_ns() ints until a response model is built from them
+@dataclass(slots=True)
+class HouseMonitorStateData:
+    timestamp: Optional[int] = None
+    uptime_s: Optional[int] = None
+    health: Optional[str] = None
+    city_power: Optional[str] = None
+    freezer_temperature_f: Optional[float] = None
+    freezer_door: Optional[str] = None
+    freezer_door_ajar_s: Optional[int] = None
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+    memory_free: Optional[int] = None
+    memory_allocated: Optional[int] = None
+    last_updated_ns: Optional[int] = None
+
+
+@dataclass(slots=True)
+class GarageControllerStateData:
+    timestamp: Optional[int] = None
+    uptime_s: Optional[int] = None
+    health: Optional[str] = None
+    door_state: Optional[str] = None
+    light_state: Optional[str] = None
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+    memory_free: Optional[int] = None
+    memory_allocated: Optional[int] = None
+    last_updated_ns: Optional[int] = None
+
+
+def _state_out(model_cls, data):
+    """Snapshot a state dataclass as its response model, converting last_updated_ns."""
+    values = {f.name: getattr(data, f.name) for f in fields(data) if f.name != 'last_updated_ns'}
+    return model_cls.model_construct(last_updated=_utc_from_ns(data.last_updated_ns), **values)
+
+
+weather_state = WeatherStateData()
+freezer_state = FreezerStateData()
+door_state = DoorStateData()
+house_monitor_state = HouseMonitorStateData()
+garage_controller_state = GarageControllerStateData()
+
+# Precompiled slug pattern for SOS error codes
+_SLUG_NONALNUM = re.compile(r"[^a-z0-9]+")
+
+# Bytes a numeric sensor payload (e.g. b"72.5") can start with
+_FLOAT_LEAD = frozenset(b"-0123456789")
+
+def _safe_float(payload: bytes) -> Optional[float]:
+    """Parse a numeric sensor payload, or return None if it is not a finite number."""
+    # First-byte reject keeps obviously bad payloads off float()'s exception path
+    if not payload or payload[0] not in _FLOAT_LEAD:
+        return None
+    try:
+        value = float(payload)
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
 
 def _derive_error_code(details: Dict[str, Any]) -> str:
     """Derive a machine-friendly error code from SOS details.
@@ -493,26 +787,113 @@ def _derive_error_code(details: Dict[str, Any]) -> str:
     """
     raw = details.get('code') or details.get('error') or details.get('message') or 'unknown_error'
     try:
-        s = str(raw).strip().lower()
-        # Replace non-alphanum with underscores and collapse repeats
-        import re
-        s = re.sub(r"[^a-z0-9]+", "_", s)
-        s = re.sub(r"_+", "_", s).strip('_')
+        # Runs of non-alphanum collapse to a single underscore in one pass
+        s = _SLUG_NONALNUM.sub("_", str(raw).strip().lower()).strip('_')
         return s or 'unknown_error'
     except Exception:
         return 'unknown_error'
 
-def update_light_state(new_state: Dict[str, Any]):
-    """Update the in-memory light state."""
-    global garage_light_state
+def update_light_state(new_state: Dict[str, Any]) -> LightStateData:
+    """Update the in-memory light state in place."""
     # Convert string state to dict if needed
     if isinstance(new_state, str):
         new_state = {"state": new_state}
-    garage_light_state = LightState(**{**garage_light_state.dict(), **new_state})
+    garage_light_state.state = new_state["state"]
+    if "last_updated" in new_state:
+        garage_light_state.last_updated = new_state["last_updated"]
     return garage_light_state
 
+def _light_state_out() -> LightState:
+    """Snapshot the light state as its response model."""
+    return LightState.model_construct(state=garage_light_state.state, last_updated=garage_light_state.last_updated)
+
+# System topic handlers (home/system/<device_id>/<type>), keyed by <type>
+def _on_system_health(device_id: str, payload: bytes, now: datetime) -> None:
+    _db_pending.op(_persist_system_health, device_id, payload, now)
+    status = _STATUS_LOOKUP.get(payload)
+    if status is None:
+        logger.debug("Unknown health status %r from %s", payload, device_id)
+        return
+    update_device_status(device_id, now=now, status=status)
+
+def _on_system_sos(device_id: str, payload: bytes, now: datetime) -> None:
+    error_info = orjson.loads(payload) if payload else {}
+    _db_pending.op(_persist_system_sos, device_id, error_info, now)
+    code = _derive_error_code(error_info)
+    record_alert(device_id, code, error_info.get('message') or error_info.get('error'), now)
+    update_device_status(
+        device_id,
+        now=now,
+        status=DeviceStatus.NEEDS_HELP,
+        last_error=error_info.get('message', 'Unknown error'),
+        last_error_code=code,
+    )
+
+def _on_system_boot(device_id: str, payload: bytes, now: datetime) -> None:
+    try:
+        last_boot = datetime.utcfromtimestamp(int(payload) / 1000)
+    except (ValueError, OverflowError, OSError):
+        # Unparseable device clock: fall back to the message's receive time, as the DB path does
+        last_boot = now
+    _db_pending.op(_persist_system_boot, device_id, last_boot, now)
+    update_device_status(device_id, now=now, last_boot=last_boot)
+
+def _on_system_version(device_id: str, payload: bytes, now: datetime) -> None:
+    _db_pending.op(_persist_system_version, device_id, payload, now)
+    update_device_status(device_id, now=now, version=payload.decode())
+
+# Values the device_logs CHECK constraint and int columns accept; device logs are COPYed in
+# batches, so a row the table would reject is dropped here instead of failing its whole batch
+_LOG_LEVELS = frozenset({'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'})
+_DEVICE_ID_MAX = 64  # devices.device_id is String(64)
+_INT32_MIN, _INT32_MAX = -(1 << 31), (1 << 31) - 1
+
+def _int32_or_none(value: Any) -> Optional[int]:
+    if isinstance(value, int) and not isinstance(value, bool) and _INT32_MIN <= value <= _INT32_MAX:
+        return value
+    return None
+
+# Handle device logs: home/system/{device_id}/log
+def _on_system_log(device_id: str, payload: bytes, now: datetime) -> None:
+    try:
+        log_data = orjson.loads(payload) if payload else {}
+        level = str(log_data.get('level', 'INFO')).upper()
+    except (orjson.JSONDecodeError, AttributeError) as e:
+        logger.warning("Failed to process device log from %s: %s", device_id, e)
+        return
+    if level not in _LOG_LEVELS:
+        logger.warning("Dropping device log from %s with unknown level %r", device_id, level)
+        return
+    if len(device_id) > _DEVICE_ID_MAX:
+        logger.warning("Dropping device log from over-long device id %r", device_id)
+        return
+    details = log_data.get('details')
+    batch = _db_pending
+    batch.ensure_devices.add(device_id)
+    batch.logs.append((
+        device_id,
+        level,
+        str(log_data.get('component', 'unknown'))[:32],
+        str(log_data.get('message', '')),
+        orjson.dumps(details).decode() if details is not None else None,
+        _int32_or_none(log_data.get('timestamp')),
+        _int32_or_none(log_data.get('sequence')),
+        now,
+        now,
+    ))
+
+_SYSTEM_HANDLERS: Dict[str, Callable[[str, bytes, datetime], None]] = {
+    'health': _on_system_health,
+    'sos': _on_system_sos,
+    'boot': _on_system_boot,
+    'version': _on_system_version,
+    'log': _on_system_log,
+}
+
 # MQTT Client Setup
 def on_connect(client, userdata, flags, reason_code, properties=None):
+    global _mqtt_connected
+    _mqtt_connected = reason_code == 0
     if reason_code == 0:
         logger.info("Connected to MQTT Broker!")
         # Subscribe to system and garage topics
@@ -534,231 +915,288 @@ def on_connect(client, userdata, flags, reason_code, properties=None):
             GARAGE_CONTROLLER_STATUS_TOPIC,
         )
     else:
-        logger.error(f"Failed to connect to MQTT Broker with code: {reason_code}")
+        logger.error("Failed to connect to MQTT Broker with code: %s", reason_code)
 
-def on_message(client, userdata, msg):
-    """Handle incoming MQTT messages."""
-    topic = msg.topic
-    payload = msg.payload.decode()
-    logger.debug(f"Received `{payload}` from `{topic}` topic")
-    
+# Applied to each broker socket as paho opens it (paho 2.0 has no socket_options setting)
+_MQTT_SOCKET_OPTIONS = (
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20),
+    (socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20),
+)
+
+def on_socket_open(client, userdata, sock):
+    for level, option, value in _MQTT_SOCKET_OPTIONS:
+        try:
+            sock.setsockopt(level, option, value)
+        except (AttributeError, OSError) as e:
+            logger.debug("Could not set MQTT socket option %s: %s", option, e)
+
+def on_disconnect(client, userdata, flags, reason_code, properties=None):
+    global _mqtt_connected
+    _mqtt_connected = False
+    logger.warning("Disconnected from MQTT Broker (code: %s)", reason_code)
+
+# Handle garage light state
+def _on_garage_light(payload: bytes, now_ns: int, now: datetime) -> None:
+    light = payload.decode()
+    _db_pending.reading(GARAGE_DEVICE_ID, 'garage_light', now, value_text=light)
+    update_light_state(light)
+    broadcast_state_update("light", {"state": light})
+
+# Handle door status
+def _on_garage_door(payload: bytes, now_ns: int, now: datetime) -> None:
+    try:
+        door_state.state = payload.decode()
+        _db_pending.reading(GARAGE_DEVICE_ID, 'garage_door', now, value_text=door_state.state)
+        door_state.last_updated_ns = now_ns
+        broadcast_state_update("door", {"state": door_state.state})
+    except Exception:
+        pass
+
+# Handle weather-station weather topics (from dedicated weather-station device)
+def _on_weather_temp(payload: bytes, now_ns: int, now: datetime) -> None:
+    value = _safe_float(payload)
+    if value is not None:
+        weather_state.temperature_f = value
+        _db_pending.reading(WEATHER_STATION_DEVICE_ID, 'weather_temperature_f', now, value_float=value)
+        weather_state.last_updated_ns = now_ns
+        broadcast_state_update("weather", {
+            "temperature_f": weather_state.temperature_f,
+            "pressure_inhg": weather_state.pressure_inhg
+        })
+    else:
+        logger.warning("Invalid temperature payload: %r", payload)
+
+def _on_weather_pressure(payload: bytes, now_ns: int, now: datetime) -> None:
+    value = _safe_float(payload)
+    if value is not None:
+        weather_state.pressure_inhg = value
+        _db_pending.reading(WEATHER_STATION_DEVICE_ID, 'weather_pressure_inhg', now, value_float=value)
+        weather_state.last_updated_ns = now_ns
+        broadcast_state_update("weather", {
+            "temperature_f": weather_state.temperature_f,
+            "pressure_inhg": weather_state.pressure_inhg
+        })
+    else:
+        logger.warning("Invalid pressure payload: %r", payload)
+
+# Handle house-monitor consolidated status
+def _on_house_monitor_status(payload: bytes, now_ns: int, now: datetime) -> None:
     try:
+        data = orjson.loads(payload) or {}
+        power = data.get('power') or {}
+        freezer = data.get('freezer') or {}
+        memory = data.get('memory') or {}
+
+        # Update in-memory state
+        house_monitor_state.timestamp = data.get('timestamp')
+        house_monitor_state.uptime_s = data.get('uptime_s')
+        house_monitor_state.health = data.get('health')
+        house_monitor_state.city_power = power.get('city')
+        house_monitor_state.freezer_temperature_f = freezer.get('temperature_f')
+        house_monitor_state.freezer_door = freezer.get('door')
+        house_monitor_state.freezer_door_ajar_s = freezer.get('door_ajar_s')
+        house_monitor_state.errors = data.get('errors', [])
+        house_monitor_state.memory_free = memory.get('free')
+        house_monitor_state.memory_allocated = memory.get('allocated')
+        house_monitor_state.last_updated_ns = now_ns
+
+        # Broadcast to websocket clients
+        broadcast_state_update("house-monitor", {
+            "city_power": house_monitor_state.city_power,
+            "freezer_temperature_f": house_monitor_state.freezer_temperature_f,
+            "freezer_door": house_monitor_state.freezer_door,
+            "freezer_door_ajar_s": house_monitor_state.freezer_door_ajar_s,
+            "health": house_monitor_state.health,
+        })
+
+        # Update device registry
+        status = DeviceStatus.ONLINE if house_monitor_state.health == 'online' else DeviceStatus.NEEDS_HELP
+        update_device_status(HOUSE_MONITOR_DEVICE_ID, now=now, status=status)
+
+        # Track errors as alerts
+        for error in house_monitor_state.errors:
+            code = error.get('code', 'unknown_error')
+            record_alert(HOUSE_MONITOR_DEVICE_ID, code, error.get('message'), now)
+
+        # Record sensor readings; heartbeat repeats are dropped by reading_if_changed
+        batch = _db_pending
+        batch.ensure_devices.add(HOUSE_MONITOR_DEVICE_ID)
+        city_power = house_monitor_state.city_power
+        if city_power:
+            batch.reading_if_changed(HOUSE_MONITOR_DEVICE_ID, 'city_power', now, value_text=city_power)
+        freezer_temp = house_monitor_state.freezer_temperature_f
+        if freezer_temp is not None:
+            batch.reading_if_changed(HOUSE_MONITOR_DEVICE_ID, 'house_freezer_temperature_f', now, value_float=float(freezer_temp))
+        freezer_door = house_monitor_state.freezer_door
+        if freezer_door:
+            batch.reading_if_changed(HOUSE_MONITOR_DEVICE_ID, 'house_freezer_door', now, value_text=freezer_door)
+        # Door ajar time only while the door is open
+        door_ajar_s = house_monitor_state.freezer_door_ajar_s
+        if door_ajar_s is not None and door_ajar_s > 0:
+            batch.reading_if_changed(HOUSE_MONITOR_DEVICE_ID, 'house_freezer_door_ajar_s', now, value_float=float(door_ajar_s))
+
+        logger.debug("House monitor status updated: health=%s, city_power=%s", house_monitor_state.health, house_monitor_state.city_power)
+    except orjson.JSONDecodeError:
+        logger.warning("Invalid JSON in house-monitor status: %s", payload)
+    except Exception as e:
+        logger.error("Error processing house-monitor status: %s", e)
+
+# Handle garage-controller consolidated status
+# Note: Weather and freezer sensors have moved to weather-station device
+def _on_garage_controller_status(payload: bytes, now_ns: int, now: datetime) -> None:
+    try:
+        data = orjson.loads(payload) or {}
+        door = data.get('door') or {}
+        light = data.get('light') or {}
+        memory = data.get('memory') or {}
+
+        # Update in-memory state
+        garage_controller_state.timestamp = data.get('timestamp')
+        garage_controller_state.uptime_s = data.get('uptime_s')
+        garage_controller_state.health = data.get('health')
+        garage_controller_state.door_state = door.get('state')
+        garage_controller_state.light_state = light.get('state')
+        garage_controller_state.errors = data.get('errors', [])
+        garage_controller_state.memory_free = memory.get('free')
+        garage_controller_state.memory_allocated = memory.get('allocated')
+        garage_controller_state.last_updated_ns = now_ns
+
+        # Broadcast to websocket clients
+        broadcast_state_update("garage-controller", {
+            "door_state": garage_controller_state.door_state,
+            "light_state": garage_controller_state.light_state,
+            "health": garage_controller_state.health,
+        })
+
+        # Update device registry
+        status = DeviceStatus.ONLINE if garage_controller_state.health == 'online' else DeviceStatus.NEEDS_HELP
+        update_device_status(GARAGE_DEVICE_ID, now=now, status=status)
+
+        # Track errors as alerts
+        for error in garage_controller_state.errors:
+            code = error.get('code', 'unknown_error')
+            record_alert(GARAGE_DEVICE_ID, code, error.get('message'), now)
+
+        # Record sensor readings; heartbeat repeats are dropped by reading_if_changed
+        batch = _db_pending
+        batch.ensure_devices.add(GARAGE_DEVICE_ID)
+        if garage_controller_state.door_state:
+            batch.reading_if_changed(GARAGE_DEVICE_ID, 'garage_door', now, value_text=garage_controller_state.door_state)
+        if garage_controller_state.light_state:
+            batch.reading_if_changed(GARAGE_DEVICE_ID, 'garage_light', now, value_text=garage_controller_state.light_state)
+
+        logger.debug("Garage controller status updated: health=%s, door=%s", garage_controller_state.health, garage_controller_state.door_state)
+    except orjson.JSONDecodeError:
+        logger.warning("Invalid JSON in garage-controller status: %s", payload)
+    except Exception as e:
+        logger.error("Error processing garage-controller status: %s", e)
+
+# Handle weather-station consolidated status
+def _on_weather_station_status(payload: bytes, now_ns: int, now: datetime) -> None:
+    try:
+        data = orjson.loads(payload) or {}
+        weather = data.get('weather') or {}
+
+        # Update weather state from consolidated status
+        weather_temp = weather.get('temperature_f')
+        weather_pressure = weather.get('pressure_inhg')
+        if weather_temp is not None:
+            weather_state.temperature_f = weather_temp
+            weather_state.last_updated_ns = now_ns
+        if weather_pressure is not None:
+            weather_state.pressure_inhg = weather_pressure
+            weather_state.last_updated_ns = now_ns
+
+        # Broadcast to websocket clients
+        broadcast_state_update("weather-station", {
+            "weather_temperature_f": weather_temp,
+            "weather_pressure_inhg": weather_pressure,
+            "health": data.get('health'),
+        })
+
+        # Update device registry
+        health = data.get('health', 'online')
+        status = DeviceStatus.ONLINE if health == 'online' else DeviceStatus.NEEDS_HELP
+        update_device_status(WEATHER_STATION_DEVICE_ID, now=now, status=status)
+
+        # Track errors as alerts
+        for error in data.get('errors', []):
+            code = error.get('code', 'unknown_error')
+            record_alert(WEATHER_STATION_DEVICE_ID, code, error.get('message'), now)
+
+        # Record sensor readings; heartbeat repeats are dropped by reading_if_changed
+        batch = _db_pending
+        batch.ensure_devices.add(WEATHER_STATION_DEVICE_ID)
+        if weather_temp is not None:
+            batch.reading_if_changed(WEATHER_STATION_DEVICE_ID, 'weather_temperature_f', now, value_float=float(weather_temp))
+        if weather_pressure is not None:
+            batch.reading_if_changed(WEATHER_STATION_DEVICE_ID, 'weather_pressure_inhg', now, value_float=float(weather_pressure))
+
+        logger.debug("Weather station status updated: health=%s, temp=%s, pressure=%s", health, weather_temp, weather_pressure)
+    except orjson.JSONDecodeError:
+        logger.warning("Invalid JSON in weather-station status: %s", payload)
+    except Exception as e:
+        logger.error("Error processing weather-station status: %s", e)
+
+# Exact-topic dispatch, built once: one dict lookup per message instead of an elif cascade.
+# Each handler parses its payload once and applies it to state, websocket clients and _db_pending.
+_TOPIC_HANDLERS: Dict[str, Callable[[bytes, int, datetime], None]] = {
+    GARAGE_LIGHT_TOPIC: _on_garage_light,
+    GARAGE_DOOR_STATUS_TOPIC: _on_garage_door,
+    WEATHER_STATION_WEATHER_TEMP_TOPIC: _on_weather_temp,
+    WEATHER_STATION_WEATHER_PRESSURE_TOPIC: _on_weather_pressure,
+    HOUSE_MONITOR_STATUS_TOPIC: _on_house_monitor_status,
+    GARAGE_CONTROLLER_STATUS_TOPIC: _on_garage_controller_status,
+    WEATHER_STATION_STATUS_TOPIC: _on_weather_station_status,
+}
+def _ingest_mqtt(
+    topic: str,
+    payload: bytes,
+    now_ns: int,
+    # Runs once per MQTT message: bind the fixed dispatch tables and helpers as locals
+    # (LOAD_FAST) instead of module globals. _db_pending and its wake event are
+    # rebound at runtime, so they stay global.
+    _system_prefix=SYSTEM_TOPIC_PREFIX,
+    _system_prefix_len=_SYSTEM_PREFIX_LEN,
+    _system_handlers=_SYSTEM_HANDLERS,
+    _topic_handlers=_TOPIC_HANDLERS,
+    _from_ns=_utc_from_ns,
+    _logger=logger,
+) -> None:
+    """Dispatch an MQTT message to its handler, then wake the DB writer (loop thread).
+
+    Handlers parse the payload once and fan it out to in-memory state, websocket
+    broadcasts and _db_pending.
+    """
+    _logger.debug("Received `%s` from `%s` topic", payload, topic)
+
+    try:
+        # One timestamp per message, shared by state, alerts and every DB row it produces
+        now = _from_ns(now_ns)
         # Handle system topics (home/system/<device_id>/<type>)
-        if topic.startswith("home/system/"):
-            parts = topic.split('/')
-            if len(parts) >= 4:  # home/system/<device_id>/<type>
-                device_id = parts[2]
-                msg_type = parts[3]
-                
-                if msg_type == 'health':
-                    update_device_status(device_id, status=DeviceStatus(payload))
-                elif msg_type == 'sos':
-                    error_info = json.loads(payload) if payload else {}
-                    code = _derive_error_code(error_info)
-                    now = datetime.utcnow()
-                    current_alerts[(device_id, code)] = AlertItem(
-                        device_id=device_id,
-                        code=code,
-                        message=error_info.get('message') or error_info.get('error'),
-                        last_seen=now,
-                    )
-                    update_device_status(
-                        device_id,
-                        status=DeviceStatus.NEEDS_HELP,
-                        last_error=error_info.get('message', 'Unknown error'),
-                        last_error_code=code,
-                    )
-                elif msg_type == 'boot':
-                    update_device_status(
-                        device_id,
-                        last_boot=datetime.utcfromtimestamp(int(payload) / 1000)
-                    )
-                elif msg_type == 'version':
-                    update_device_status(device_id, version=payload)
-        
-        # Handle garage light state
-        elif topic == GARAGE_LIGHT_TOPIC:
-            update_light_state(payload)
-            broadcast_state_update("light", {"state": payload})
-        # Handle door status
-        elif topic == GARAGE_DOOR_STATUS_TOPIC:
-            try:
-                door_state.state = payload
-                door_state.last_updated = datetime.utcnow()
-                broadcast_state_update("door", {"state": door_state.state})
-            except Exception:
-                pass
-        # Handle weather-station weather topics (from dedicated weather-station device)
-        elif topic == WEATHER_STATION_WEATHER_TEMP_TOPIC:
-            try:
-                weather_state.temperature_f = float(payload)
-                weather_state.last_updated = datetime.utcnow()
-                broadcast_state_update("weather", {
-                    "temperature_f": weather_state.temperature_f,
-                    "pressure_inhg": weather_state.pressure_inhg
-                })
-            except Exception:
-                logger.warning(f"Invalid temperature payload: {payload}")
-        elif topic == WEATHER_STATION_WEATHER_PRESSURE_TOPIC:
-            try:
-                weather_state.pressure_inhg = float(payload)
-                weather_state.last_updated = datetime.utcnow()
-                broadcast_state_update("weather", {
-                    "temperature_f": weather_state.temperature_f,
-                    "pressure_inhg": weather_state.pressure_inhg
-                })
-            except Exception:
-                logger.warning(f"Invalid pressure payload: {payload}")
-
-        # Handle house-monitor consolidated status
-        elif topic == HOUSE_MONITOR_STATUS_TOPIC:
-            try:
-                data = json.loads(payload)
-                now = datetime.utcnow()
-
-                # Update in-memory state
-                house_monitor_state.timestamp = data.get('timestamp')
-                house_monitor_state.uptime_s = data.get('uptime_s')
-                house_monitor_state.health = data.get('health')
-                house_monitor_state.city_power = data.get('power', {}).get('city')
-                house_monitor_state.freezer_temperature_f = data.get('freezer', {}).get('temperature_f')
-                house_monitor_state.freezer_door = data.get('freezer', {}).get('door')
-                house_monitor_state.freezer_door_ajar_s = data.get('freezer', {}).get('door_ajar_s')
-                house_monitor_state.errors = data.get('errors', [])
-                house_monitor_state.memory_free = data.get('memory', {}).get('free')
-                house_monitor_state.memory_allocated = data.get('memory', {}).get('allocated')
-                house_monitor_state.last_updated = now
-
-                # Broadcast to websocket clients
-                broadcast_state_update("house-monitor", {
-                    "city_power": house_monitor_state.city_power,
-                    "freezer_temperature_f": house_monitor_state.freezer_temperature_f,
-                    "freezer_door": house_monitor_state.freezer_door,
-                    "freezer_door_ajar_s": house_monitor_state.freezer_door_ajar_s,
-                    "health": house_monitor_state.health,
-                })
-
-                # Update device registry
-                status = DeviceStatus.ONLINE if house_monitor_state.health == 'online' else DeviceStatus.NEEDS_HELP
-                update_device_status(HOUSE_MONITOR_DEVICE_ID, status=status)
-
-                # Track errors as alerts
-                for error in house_monitor_state.errors:
-                    code = error.get('code', 'unknown_error')
-                    current_alerts[(HOUSE_MONITOR_DEVICE_ID, code)] = AlertItem(
-                        device_id=HOUSE_MONITOR_DEVICE_ID,
-                        code=code,
-                        message=error.get('message'),
-                        last_seen=now,
-                    )
-
-                logger.debug(f"House monitor status updated: health={house_monitor_state.health}, city_power={house_monitor_state.city_power}")
-            except json.JSONDecodeError:
-                logger.warning(f"Invalid JSON in house-monitor status: {payload}")
-            except Exception as e:
-                logger.error(f"Error processing house-monitor status: {e}")
-
-        # Handle garage-controller consolidated status
-        # Note: Weather and freezer sensors have moved to weather-station device
-        elif topic == GARAGE_CONTROLLER_STATUS_TOPIC:
-            try:
-                data = json.loads(payload)
-                now = datetime.utcnow()
-
-                # Update in-memory state
-                garage_controller_state.timestamp = data.get('timestamp')
-                garage_controller_state.uptime_s = data.get('uptime_s')
-                garage_controller_state.health = data.get('health')
-                garage_controller_state.door_state = data.get('door', {}).get('state')
-                garage_controller_state.light_state = data.get('light', {}).get('state')
-                garage_controller_state.errors = data.get('errors', [])
-                garage_controller_state.memory_free = data.get('memory', {}).get('free')
-                garage_controller_state.memory_allocated = data.get('memory', {}).get('allocated')
-                garage_controller_state.last_updated = now
-
-                # Broadcast to websocket clients
-                broadcast_state_update("garage-controller", {
-                    "door_state": garage_controller_state.door_state,
-                    "light_state": garage_controller_state.light_state,
-                    "health": garage_controller_state.health,
-                })
-
-                # Update device registry
-                status = DeviceStatus.ONLINE if garage_controller_state.health == 'online' else DeviceStatus.NEEDS_HELP
-                update_device_status(GARAGE_DEVICE_ID, status=status)
-
-                # Track errors as alerts
-                for error in garage_controller_state.errors:
-                    code = error.get('code', 'unknown_error')
-                    current_alerts[(GARAGE_DEVICE_ID, code)] = AlertItem(
-                        device_id=GARAGE_DEVICE_ID,
-                        code=code,
-                        message=error.get('message'),
-                        last_seen=now,
-                    )
-
-                logger.debug(f"Garage controller status updated: health={garage_controller_state.health}, door={garage_controller_state.door_state}")
-            except json.JSONDecodeError:
-                logger.warning(f"Invalid JSON in garage-controller status: {payload}")
-            except Exception as e:
-                logger.error(f"Error processing garage-controller status: {e}")
-
-        # Handle weather-station consolidated status
-        elif topic == WEATHER_STATION_STATUS_TOPIC:
-            try:
-                data = json.loads(payload)
-                now = datetime.utcnow()
-
-                # Update weather state from consolidated status
-                weather_temp = data.get('weather', {}).get('temperature_f')
-                weather_pressure = data.get('weather', {}).get('pressure_inhg')
-                if weather_temp is not None:
-                    weather_state.temperature_f = weather_temp
-                    weather_state.last_updated = now
-                if weather_pressure is not None:
-                    weather_state.pressure_inhg = weather_pressure
-                    weather_state.last_updated = now
-
-                # Broadcast to websocket clients
-                broadcast_state_update("weather-station", {
-                    "weather_temperature_f": weather_temp,
-                    "weather_pressure_inhg": weather_pressure,
-                    "health": data.get('health'),
-                })
-
-                # Update device registry
-                health = data.get('health', 'online')
-                status = DeviceStatus.ONLINE if health == 'online' else DeviceStatus.NEEDS_HELP
-                update_device_status(WEATHER_STATION_DEVICE_ID, status=status)
-
-                # Track errors as alerts
-                for error in data.get('errors', []):
-                    code = error.get('code', 'unknown_error')
-                    current_alerts[(WEATHER_STATION_DEVICE_ID, code)] = AlertItem(
-                        device_id=WEATHER_STATION_DEVICE_ID,
-                        code=code,
-                        message=error.get('message'),
-                        last_seen=now,
-                    )
-
-                logger.debug(f"Weather station status updated: health={health}, temp={weather_temp}, pressure={weather_pressure}")
-            except json.JSONDecodeError:
-                logger.warning(f"Invalid JSON in weather-station status: {payload}")
-            except Exception as e:
-                logger.error(f"Error processing weather-station status: {e}")
-
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse MQTT message: {payload}")
+        if topic.startswith(_system_prefix):
+            device_id, _, rest = topic[_system_prefix_len:].partition('/')
+            handler = _system_handlers.get(rest.partition('/')[0])
+            if device_id and handler is not None:
+                handler(device_id, payload, now)
+        else:
+            handler = _topic_handlers.get(topic)
+            if handler is not None:
+                handler(payload, now_ns, now)
     except Exception as e:
-        logger.error(f"Error processing MQTT message: {e}")
-        logger.exception(e)
+        _logger.error("Error processing MQTT message: %s", e)
+        _logger.exception(e)
     finally:
-        # Schedule DB persistence on the app's event loop
-        try:
-            if _event_loop is not None:
-                asyncio.run_coroutine_threadsafe(process_mqtt_event(topic, payload), _event_loop)
-        except Exception as ex:
-            logger.error(f"Failed to schedule DB task for topic {topic}: {ex}")
+        _db_pending_wake.set()
+
+
+def on_message(client, userdata, msg, _ingest=_ingest_mqtt, _time_ns=time.time_ns):
+    """Hand incoming MQTT messages to the event loop; nothing is parsed on the paho thread."""
+    loop = _event_loop
+    if loop is not None:
+        # Payload kept as bytes: orjson.loads, float() and int() all accept bytes directly
+        loop.call_soon_threadsafe(_ingest, msg.topic, msg.payload, _time_ns())
 
 # Application Lifespan
 @asynccontextmanager
@@ -770,21 +1208,33 @@ async def lifespan(app: FastAPI):
     try:
         mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         mqtt_client.on_connect = on_connect
+        mqtt_client.on_disconnect = on_disconnect
         mqtt_client.on_message = on_message
+        mqtt_client.on_socket_open = on_socket_open
+        mqtt_client.max_inflight_messages_set(100)
+        mqtt_client.max_queued_messages_set(10000)
+        mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
     except Exception as e:
-        logger.error(f"Failed to initialize MQTT client: {e}")
+        logger.error("Failed to initialize MQTT client: %s", e)
         raise
     
-    if MQTT_USERNAME and MQTT_PASSWORD:
-        mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    if settings.mqtt_username and settings.mqtt_password:
+        mqtt_client.username_pw_set(settings.mqtt_username, settings.mqtt_password)
     
+    # Capture the event loop before connecting: retained health/version messages and LWTs
+    # arrive right after subscribe, while init_db below is still running. Their state updates
+    # apply immediately and their DB work waits in _db_pending until the writer starts.
+    global _event_loop, _db_pending_wake, _db_writer_stopping, _mqtt_send
+    _db_pending_wake = asyncio.Event()
+    _event_loop = asyncio.get_running_loop()
+
     try:
-        mqtt_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
+        mqtt_client.connect(settings.mqtt_broker_host, settings.mqtt_broker_port, keepalive=30)
         mqtt_client.loop_start()
         app.state.mqtt_client = mqtt_client
         logger.info("MQTT client started successfully")
     except Exception as e:
-        logger.error(f"Failed to start MQTT client: {e}")
+        logger.error("Failed to start MQTT client: %s", e)
         raise
     
     # Initialize database (create tables if not present)
@@ -792,13 +1242,18 @@ async def lifespan(app: FastAPI):
         logger.info("Initializing database (creating tables if needed)...")
         await init_db()
         logger.info("Database initialized")
+        # Raw asyncpg pool for hot read-only endpoints (weather history)
+        app.state.pg = await create_pg_pool()
     except Exception as e:
-        logger.error(f"Database initialization failed: {e}")
+        logger.error("Database initialization failed: %s", e)
         raise
 
-    # Capture event loop for cross-thread scheduling
-    global _event_loop
-    _event_loop = asyncio.get_running_loop()
+    # Tables exist now; start the DB writer (it flushes anything queued during startup first)
+    mqtt_writer = asyncio.create_task(_drain_db_pending())
+    # Fire-and-forget command publishes; handlers return once the command is queued
+    app.state.mqtt_tx = asyncio.Queue()
+    _mqtt_send = app.state.mqtt_tx.put_nowait
+    mqtt_publisher = asyncio.create_task(_drain_mqtt_outbox(mqtt_client, app.state.mqtt_tx))
     
     # Ensure device rows exist so sensor_readings FK constraints are satisfied
     try:
@@ -815,17 +1270,34 @@ async def lifespan(app: FastAPI):
     yield  # Application runs here
     
     # Shutdown
+    # Publish the commands still queued, then disconnect so no new DB work arrives
+    app.state.mqtt_tx.put_nowait(None)
+    await mqtt_publisher
     logger.info("Shutting down MQTT client...")
-    mqtt_client.loop_stop()
     mqtt_client.disconnect()
+    mqtt_client.loop_stop()
     logger.info("MQTT client shut down")
+    # Let messages already handed to the loop reach _db_pending, then have the writer
+    # flush everything queued since its last wake-up before it exits
+    await asyncio.sleep(0)
+    _db_writer_stopping = True
+    _db_pending_wake.set()
+    try:
+        await asyncio.wait_for(mqtt_writer, timeout=DB_SHUTDOWN_FLUSH_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        logger.error("MQTT DB writer did not finish its final flush within %ss", DB_SHUTDOWN_FLUSH_TIMEOUT_S)
+    except Exception as ex:
+        logger.error("MQTT DB writer failed: %s", ex)
+    await app.state.pg.close()
+    await _ota_http.aclose()
 
 # Create FastAPI app
 app = FastAPI(
     title="IRIS Home Automation API",
     description="API for the IRIS (Intelligent Residence Information System)",
     version="0.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # CORS Middleware
@@ -842,7 +1314,7 @@ app.add_middleware(
 async def health_check():
     return {
         "status": "healthy",
-        "mqtt_connected": app.state.mqtt_client.is_connected() if hasattr(app.state, 'mqtt_client') else False
+        "mqtt_connected": _mqtt_connected
     }
 
 # Root Endpoint
@@ -862,7 +1334,7 @@ async def db_health():
         result = await db_health_check()
         return {"status": "ok", **result}
     except Exception as e:
-        logger.error(f"DB health check failed: {e}")
+        logger.error("DB health check failed: %s", e)
         raise HTTPException(status_code=503, detail="Database unavailable")
 
 # Garage Light Endpoints
@@ -874,21 +1346,21 @@ async def toggle_garage_light():
         new_state = "on" if garage_light_state.state == "off" else "off"
         
         # Publish the command to MQTT (simple string 'on' or 'off')
-        app.state.mqtt_client.publish(GARAGE_LIGHT_COMMAND_TOPIC, new_state)
+        _mqtt_send((GARAGE_LIGHT_COMMAND_TOPIC, new_state.encode()))
         
         # Update local state
-        updated_state = update_light_state({"state": new_state, "last_updated": "now"})
+        update_light_state({"state": new_state, "last_updated": "now"})
         
-        logger.info(f"Toggled garage light to {new_state}")
-        return updated_state
+        logger.info("Toggled garage light to %s", new_state)
+        return _light_state_out()
     except Exception as e:
-        logger.error(f"Error toggling garage light: {e}")
+        logger.error("Error toggling garage light: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/garage/light/state", response_model=LightState)
 async def get_garage_light_state():
     """Get the current garage light state."""
-    return garage_light_state
+    return _light_state_out()
 
 # Weather and freezer sensor endpoints (data from weather-station device)
 @app.get("/api/garage/weather", response_model=WeatherState)
@@ -898,7 +1370,11 @@ async def get_garage_weather():
     Note: Data is now sourced from the dedicated weather-station device,
     which has short sensor runs for improved reliability.
     """
-    return weather_state
+    return WeatherState.model_construct(
+        temperature_f=weather_state.temperature_f,
+        pressure_inhg=weather_state.pressure_inhg,
+        last_updated=_utc_from_ns(weather_state.last_updated_ns),
+    )
 
 
 @app.get("/api/garage/freezer", response_model=FreezerState)
@@ -908,13 +1384,16 @@ async def get_freezer_temperature():
     Note: Data is now sourced from the dedicated weather-station device,
     which has a short 1-Wire run to the freezer for reliable readings.
     """
-    return freezer_state
+    return FreezerState.model_construct(
+        temperature_f=freezer_state.temperature_f,
+        last_updated=_utc_from_ns(freezer_state.last_updated_ns),
+    )
 
 
 @app.get("/api/garage/door/state", response_model=DoorState)
 async def get_garage_door_state():
     """Get the current garage door state."""
-    return door_state
+    return DoorState.model_construct(state=door_state.state, last_updated=_utc_from_ns(door_state.last_updated_ns))
 
 
 # House Monitor Endpoints
@@ -928,7 +1407,7 @@ async def get_house_monitor_status():
     - Device health and any active errors
     - Memory statistics
     """
-    return house_monitor_state
+    return _state_out(HouseMonitorState, house_monitor_state)
 
 
 @app.get("/api/house-monitor/power")
@@ -936,7 +1415,7 @@ async def get_house_monitor_power():
     """Get city power status from house-monitor."""
     return {
         "city_power": house_monitor_state.city_power,
-        "last_updated": house_monitor_state.last_updated
+        "last_updated": _utc_from_ns(house_monitor_state.last_updated_ns)
     }
 
 
@@ -947,7 +1426,7 @@ async def get_house_monitor_freezer():
         "temperature_f": house_monitor_state.freezer_temperature_f,
         "door": house_monitor_state.freezer_door,
         "door_ajar_s": house_monitor_state.freezer_door_ajar_s,
-        "last_updated": house_monitor_state.last_updated
+        "last_updated": _utc_from_ns(house_monitor_state.last_updated_ns)
     }
 
 
@@ -966,7 +1445,7 @@ async def get_garage_controller_status():
     Note: This supplements the real-time door/light status topics
     with a periodic 30-second snapshot for logging and alerting.
     """
-    return garage_controller_state
+    return _state_out(GarageControllerState, garage_controller_state)
 
 
 @app.get("/api/garage-controller/summary")
@@ -981,7 +1460,7 @@ async def get_garage_controller_summary():
         "light": garage_controller_state.light_state,
         "health": garage_controller_state.health,
         "errors": garage_controller_state.errors,
-        "last_updated": garage_controller_state.last_updated
+        "last_updated": _utc_from_ns(garage_controller_state.last_updated_ns)
     }
 
 
@@ -1000,15 +1479,15 @@ async def send_garage_door_command(command: str):
         raise HTTPException(status_code=400, detail="Command must be 'open', 'close', or 'toggle'")
 
     # Ensure MQTT client is connected
-    if not hasattr(app.state, 'mqtt_client') or not app.state.mqtt_client.is_connected():
+    if not _mqtt_connected:
         raise HTTPException(status_code=503, detail="MQTT client not connected")
 
     try:
-        app.state.mqtt_client.publish(GARAGE_DOOR_COMMAND_TOPIC, cmd)
-        logger.info(f"Sent garage door command: {cmd}")
+        _mqtt_send((GARAGE_DOOR_COMMAND_TOPIC, cmd.encode()))
+        logger.info("Sent garage door command: %s", cmd)
         return {"status": "sent", "command": cmd}
     except Exception as e:
-        logger.error(f"Error sending garage door command: {e}")
+        logger.error("Error sending garage door command: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/garage/light/{state}", response_model=LightState)
@@ -1020,15 +1499,15 @@ async def set_garage_light_state(state: str):
     
     try:
         # Publish the command to MQTT (simple string 'on' or 'off')
-        app.state.mqtt_client.publish(GARAGE_LIGHT_COMMAND_TOPIC, state)
+        _mqtt_send((GARAGE_LIGHT_COMMAND_TOPIC, state.encode()))
         
         # Update local state
-        updated_state = update_light_state({"state": state, "last_updated": "now"})
+        update_light_state({"state": state, "last_updated": "now"})
         
-        logger.info(f"Set garage light to {state}")
-        return updated_state
+        logger.info("Set garage light to %s", state)
+        return _light_state_out()
     except Exception as e:
-        logger.error(f"Error setting garage light state: {e}")
+        logger.error("Error setting garage light state: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Device Management Endpoints
@@ -1041,8 +1520,22 @@ class OTAUpdateRequest(BaseModel):
     """
     ref: Optional[str] = None
 
+# device_id -> (watched dirs, their mtimes, files); see _iter_device_files
+_DEVICE_FILES_CACHE: Dict[str, Tuple[list[str], Tuple[int, ...], list[Tuple[str, str]]]] = {}
+
+def _dir_mtimes(dirs: list[str]) -> Optional[Tuple[int, ...]]:
+    """Return the mtimes of the given directories, or None if any is missing."""
+    try:
+        return tuple(os.stat(d).st_mtime_ns for d in dirs)
+    except OSError:
+        return None
+
 def _iter_device_files(device_id: str) -> list[Tuple[str, str]]:
     """Enumerate repo file paths that should be deployed for a device.
+
+    The result is memoized per device and reused until any directory in the
+    walked trees changes mtime (i.e. an entry was added, removed or renamed),
+    so repeated manifest requests cost one stat per directory.
     
     Args:
         device_id (str): Target device identifier.
@@ -1050,109 +1543,200 @@ def _iter_device_files(device_id: str) -> list[Tuple[str, str]]:
     Returns:
         list[tuple[str, str]]: Tuples of (repo_path, device_path).
     """
+    cached = _DEVICE_FILES_CACHE.get(device_id)
+    if cached is not None:
+        dirs, mtimes, files = cached
+        if _dir_mtimes(dirs) == mtimes:
+            return list(files)
+    dirs, files = _scan_device_files(device_id)
+    mtimes = _dir_mtimes(dirs)
+    if mtimes is not None:
+        _DEVICE_FILES_CACHE[device_id] = (dirs, mtimes, files)
+    return list(files)
+
+def _scan_device_files(device_id: str) -> Tuple[list[str], list[Tuple[str, str]]]:
+    """Walk the device app and shared trees.
+
+    Returns:
+        tuple[list[str], list[tuple[str, str]]]: (walked directories, (repo_path, device_path) tuples).
+    """
+    dirs: list[str] = []
     results: list[Tuple[str, str]] = []
-    # Include device-specific app files
-    device_app_dir = PROJECT_ROOT / "devices" / device_id / "app"
-    if device_app_dir.is_dir():
-        for p in device_app_dir.rglob("*"):
-            if p.is_file() and _include_in_ota(p):
-                rel = p.relative_to(PROJECT_ROOT).as_posix()
-                # Map devices/{device_id}/app/<...> -> app/<...>
-                sub = p.relative_to(device_app_dir).as_posix()
-                results.append((rel, f"app/{sub}"))
-    # Include shared modules
-    shared_dir = PROJECT_ROOT / "shared"
-    if shared_dir.is_dir():
-        for p in shared_dir.rglob("*"):
-            if p.is_file() and _include_in_ota(p):
-                rel = p.relative_to(PROJECT_ROOT).as_posix()
-                sub = p.relative_to(shared_dir).as_posix()
-                results.append((rel, f"shared/{sub}"))
-    return results
-
-def _include_in_ota(path: Path) -> bool:
-    """Return True if the file path should be included in OTA manifests.
+    root_len = len(str(PROJECT_ROOT)) + 1
+    sources = (
+        # Device-specific app files: devices/{device_id}/app/<...> -> app/<...>
+        (str(PROJECT_ROOT / "devices" / device_id / "app"), "app/"),
+        # Shared modules: shared/<...> -> shared/<...>
+        (str(PROJECT_ROOT / "shared"), "shared/"),
+    )
+    for src_dir, dest_prefix in sources:
+        src_len = len(src_dir) + 1
+        for name, full in _walk_files(src_dir, dirs):
+            rel = full[root_len:]
+            sub = full[src_len:]
+            if os.sep != "/":
+                rel = rel.replace(os.sep, "/")
+                sub = sub.replace(os.sep, "/")
+            if _include_in_ota(name, rel):
+                results.append((rel, dest_prefix + sub))
+    return dirs, results
+
+def _walk_files(root: str, dirs: list[str]) -> Iterator[Tuple[str, str]]:
+    """Yield (name, path) for every file under root using os.scandir.
+
+    Each visited directory is appended to `dirs`, including a missing root, so a
+    tree that does not exist yet is never cached. __pycache__ dirs are skipped.
+    """
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        dirs.append(current)
+        try:
+            it = os.scandir(current)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != "__pycache__":
+                        stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.name, entry.path
+
+_OTA_EXCLUDED_NAMES = frozenset({".DS_Store", "Thumbs.db"})
+_BOOTSTRAP_ROOT_FILES = frozenset({"main.py", "bootstrap_manager.py", "http_updater.py"})
+
+def _include_in_ota(name: str, rel: str) -> bool:
+    """Return True if the file should be included in OTA manifests.
     
     Excludes caches and bootstrap files by convention.
+
+    Args:
+        name (str): File basename.
+        rel (str): POSIX path relative to PROJECT_ROOT.
     """
-    name = path.name
-    if name in {".DS_Store", "Thumbs.db"}:
+    if name in _OTA_EXCLUDED_NAMES:
         return False
     if name.endswith((".pyc", ".pyo")):
         return False
-    parts = set(path.parts)
-    if "__pycache__" in parts:
-        return False
     # Guard: never include bootstrap files
-    try:
-        rel = path.relative_to(PROJECT_ROOT).as_posix()
-    except Exception:
-        rel = path.as_posix()
     if rel.startswith("devices/bootstrap/"):
         return False
-    if name in {"main.py", "bootstrap_manager.py", "http_updater.py"} and path.parent == PROJECT_ROOT:
+    if name in _BOOTSTRAP_ROOT_FILES and "/" not in rel:
         return False
     return True
 
-def _raw_url_for(repo_path: str, ref: str) -> str:
-    """Construct a raw URL for a given repo path and ref.
-    
+def _make_raw_url_for(cfg: Settings) -> Callable[[str, str], str]:
+    """Build the raw-URL constructor once for the given settings.
+
     If OTA_RAW_BASE is configured, use it as base (server proxy). Otherwise use GitHub raw URLs.
+    The base is resolved here so each manifest entry is a single f-string format.
     """
-    if OTA_RAW_BASE:
+    if cfg.ota_raw_base:
         # Expect server to accept /<ref>/<path> or similar; keep simple: base + /<ref>/<repo_path>
-        return f"{OTA_RAW_BASE}/{ref}/{repo_path}"
-    if not (GITHUB_ORG and GITHUB_REPO):
-        raise RuntimeError("GITHUB_ORG and GITHUB_REPO must be set or OTA_RAW_BASE provided")
-    return f"https://raw.githubusercontent.com/{GITHUB_ORG}/{GITHUB_REPO}/{ref}/{repo_path}"
+        base = cfg.ota_raw_base
+    elif cfg.github_org and cfg.github_repo:
+        base = f"https://raw.githubusercontent.com/{cfg.github_org}/{cfg.github_repo}"
+    else:
+        def _unconfigured(repo_path: str, ref: str) -> str:
+            raise RuntimeError("GITHUB_ORG and GITHUB_REPO must be set or OTA_RAW_BASE provided")
+        return _unconfigured
+
+    def _raw_url_for(repo_path: str, ref: str) -> str:
+        return f"{base}/{ref}/{repo_path}"
+    return _raw_url_for
+
+_raw_url_for = _make_raw_url_for(settings)
+
+# Shared by every manifest build so connections to GitHub (and their HTTP/2 streams) are reused
+_ota_http = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    # requests followed redirects by default (renamed repos, OTA_RAW_BASE proxies); httpx does not
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=32),
+    headers={"User-Agent": "iris-ota"},
+)
+# Concurrent file fetches per manifest build
+OTA_FETCH_CONCURRENCY = 16
+# Read size for streamed OTA file bodies
+OTA_HASH_CHUNK_SIZE = 64 * 1024
+
+# (repo_path, ref) -> (size, sha256) of fetched files. Content at a commit SHA never
+# changes, so those entries stay until evicted (LRU). A branch can move at any push and
+# devices reject a file whose size differs from the manifest, so branch entries only
+# live long enough to share one fetch across manifests built back to back.
+OTA_BRANCH_HASH_TTL_S = 10
+_ota_hash_cache: TTLCache = TTLCache(maxsize=4096, ttl=OTA_BRANCH_HASH_TTL_S)
+_ota_hash_pinned: LRUCache = LRUCache(maxsize=4096)
+_COMMIT_SHA_RE = re.compile(r"[0-9a-fA-F]{40}")
+
+async def _fetch_github_content_hash(repo_path: str, ref: str, sem: asyncio.Semaphore) -> Tuple[int, str]:
+    """Fetch content from GitHub and calculate its hash - ensuring consistency with what devices download.
 
-def _build_update_manifest(device_id: str, ref: Optional[str]) -> Dict[str, Any]:
+    Args:
+        repo_path (str): Repository path to fetch
+        ref (str): Git reference (branch/commit)
+        sem (asyncio.Semaphore): Bounds the fetches in flight for one manifest build
+
+    Returns:
+        tuple[int, str]: (size, sha256_hex)
+    """
+    key = (repo_path, ref)
+    pinned = _COMMIT_SHA_RE.fullmatch(ref) is not None
+    cached = _ota_hash_pinned.get(key) if pinned else _ota_hash_cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        url = _raw_url_for(repo_path, ref)
+        logger.debug("Fetching content from %s for hash calculation", url)
+
+        # Hash chunks as they arrive so digesting overlaps the download and the body is never held whole
+        digest = hashlib.sha256() if settings.ota_include_sha256 else None
+        size = 0
+        async with sem, _ota_http.stream("GET", url) as response:
+            if response.status_code != 200:
+                logger.warning("Failed to fetch %s (status %s)", url, response.status_code)
+                return 0, ""
+            async for chunk in response.aiter_bytes(OTA_HASH_CHUNK_SIZE):
+                size += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        sha256_hash = digest.hexdigest() if digest is not None else ""
+
+        logger.debug("GitHub content hash for %s: %s (%s bytes)", repo_path, sha256_hash, size)
+        result = (size, sha256_hash)
+        if pinned:
+            _ota_hash_pinned[key] = result
+        else:
+            _ota_hash_cache[key] = result
+        return result
+
+    except Exception as e:
+        logger.warning("Failed to fetch GitHub content for %s: %s", repo_path, e)
+        return 0, ""
+
+async def _build_update_manifest(device_id: str, ref: Optional[str]) -> Dict[str, Any]:
     """Build the OTA update payload for a device.
-    
+
+    Files are fetched from GitHub concurrently (at most OTA_FETCH_CONCURRENCY at a time),
+    so a build takes roughly one round-trip per OTA_FETCH_CONCURRENCY files.
+
     Args:
         device_id (str): Target device id.
         ref (str | None): Branch name or commit SHA. Defaults to env.
-    
+
     Returns:
         dict: Payload with "files" list containing url/path entries.
     """
-    use_ref = (ref or GITHUB_DEFAULT_REF).strip()
+    use_ref = (ref or settings.github_default_ref).strip()
+    # Even a cache hit stats every watched directory; keep that filesystem work off the loop
+    files = await asyncio.to_thread(_iter_device_files, device_id)
+    sem = asyncio.Semaphore(OTA_FETCH_CONCURRENCY)
+    # Calculate hashes from GitHub content instead of local files
+    hashes = await asyncio.gather(*(_fetch_github_content_hash(repo_path, use_ref, sem) for repo_path, _ in files))
     entries: list[Dict[str, Any]] = []
-    
-    def _fetch_github_content_hash(repo_path: str, ref: str) -> Tuple[int, str]:
-        """Fetch content from GitHub and calculate its hash - ensuring consistency with what devices download.
-        
-        Args:
-            repo_path (str): Repository path to fetch
-            ref (str): Git reference (branch/commit)
-            
-        Returns:
-            tuple[int, str]: (size, sha256_hex)
-        """
-        try:
-            url = _raw_url_for(repo_path, ref)
-            logger.debug(f"Fetching content from {url} for hash calculation")
-            
-            # Use a reasonable timeout to avoid hanging
-            response = requests.get(url, timeout=30)
-            if response.status_code != 200:
-                logger.warning(f"Failed to fetch {url} (status {response.status_code})")
-                return 0, ""
-            
-            content = response.content
-            size = len(content)
-            sha256_hash = hashlib.sha256(content).hexdigest()
-            
-            logger.debug(f"GitHub content hash for {repo_path}: {sha256_hash} ({size} bytes)")
-            return size, sha256_hash
-            
-        except Exception as e:
-            logger.warning(f"Failed to fetch GitHub content for {repo_path}: {e}")
-            return 0, ""
-    
-    for repo_path, device_path in _iter_device_files(device_id):
-        # Calculate hash from GitHub content instead of local files
-        size, sha = _fetch_github_content_hash(repo_path, use_ref)
+    for (repo_path, device_path), (size, sha) in zip(files, hashes):
         entry: Dict[str, Any] = {
             "url": _raw_url_for(repo_path, use_ref),
             "path": device_path,
@@ -1160,15 +1744,15 @@ def _build_update_manifest(device_id: str, ref: Optional[str]) -> Dict[str, Any]
         # Only include validators when available to keep backward-compat flexible
         if size:
             entry["size"] = size
-        # Temporarily disable SHA256 validation to fix OTA issues
+        # SHA256 validation is disabled by default to fix OTA issues (settings.ota_include_sha256)
         # TODO: Fix hash calculation consistency between server and device
-        # if sha:
-        #     entry["sha256"] = sha
+        if sha:
+            entry["sha256"] = sha
         entries.append(entry)
     if not entries:
         logger.error("OTA manifest empty for device_id=%s at PROJECT_ROOT=%s (ref=%s)", device_id, str(PROJECT_ROOT), use_ref)
         raise HTTPException(status_code=404, detail=f"No deployable files found for device_id='{device_id}' at PROJECT_ROOT='{PROJECT_ROOT}'")
-    logger.debug(f"Built OTA manifest for device_id={device_id} with {len(entries)} files")
+    logger.debug("Built OTA manifest for device_id=%s with %s files", device_id, len(entries))
     return {"files": entries}
 
 @app.get("/api/devices/{device_id}/update/manifest")
@@ -1183,11 +1767,11 @@ async def get_update_manifest(device_id: str, ref: Optional[str] = None):
         dict: Update payload with file list.
     """
     try:
-        return _build_update_manifest(device_id, ref)
+        return await _build_update_manifest(device_id, ref)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to build manifest for {device_id}: {e}")
+        logger.error("Failed to build manifest for %s: %s", device_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/devices/{device_id}/update")
@@ -1202,79 +1786,186 @@ async def trigger_device_update(device_id: str, req: OTAUpdateRequest):
         dict: Publish status and file count.
     """
     # Ensure MQTT client is connected
-    if not hasattr(app.state, 'mqtt_client') or not app.state.mqtt_client.is_connected():
+    if not _mqtt_connected:
         raise HTTPException(status_code=503, detail="MQTT client not connected")
 
     try:
-        payload = _build_update_manifest(device_id, req.ref)
+        payload = await _build_update_manifest(device_id, req.ref)
         topic = f"home/system/{device_id}/update"
-        sent = app.state.mqtt_client.publish(topic, json.dumps(payload))
-        logger.info("Published OTA update for %s with %d files (ref=%s)", device_id, len(payload.get("files", [])), (req.ref or GITHUB_DEFAULT_REF))
-        return {"status": "published", "device_id": device_id, "file_count": len(payload.get("files", [])), "ref": req.ref or GITHUB_DEFAULT_REF, "mqtt_result": getattr(sent, 'rc', 0)}
+        # orjson emits bytes, which paho sends as-is without a str->bytes encode
+        sent = app.state.mqtt_client.publish(topic, orjson.dumps(payload))
+        logger.info("Published OTA update for %s with %d files (ref=%s)", device_id, len(payload.get("files", [])), (req.ref or settings.github_default_ref))
+        return {"status": "published", "device_id": device_id, "file_count": len(payload.get("files", [])), "ref": req.ref or settings.github_default_ref, "mqtt_result": getattr(sent, 'rc', 0)}
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to publish OTA for {device_id}: {e}")
+        logger.error("Failed to publish OTA for %s: %s", device_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/devices/ota/cache/clear")
+async def clear_ota_cache():
+    """Forget cached OTA file sizes/hashes so the next manifest refetches every file.
+
+    Returns:
+        dict: Number of cached entries dropped.
+    """
+    cleared = len(_ota_hash_cache) + len(_ota_hash_pinned)
+    _ota_hash_cache.clear()
+    _ota_hash_pinned.clear()
+    logger.info("Cleared %d cached OTA file hashes", cleared)
+    return {"status": "cleared", "entries": cleared}
+
 @app.get("/api/devices", response_model=Dict[str, DeviceInfo])
 async def list_devices():
     """List all registered devices and their status."""
-    return device_registry
+    return {device_id: _device_info(device) for device_id, device in device_registry.items()}
 
 @app.get("/api/devices/{device_id}", response_model=DeviceInfo)
 async def get_device_status(device_id: str):
     """Get detailed status for a specific device."""
-    if device_id not in device_registry:
+    device = device_registry.get(device_id)
+    if device is None:
         raise HTTPException(status_code=404, detail="Device not found")
-    return device_registry[device_id]
+    return _device_info(device)
 
 @app.post("/api/devices/{device_id}/reboot")
 async def reboot_device(device_id: str):
     """Send a reboot command to the device."""
-    if not hasattr(app.state, 'mqtt_client') or not app.state.mqtt_client.is_connected():
+    if not _mqtt_connected:
         raise HTTPException(status_code=503, detail="MQTT client not connected")
     
     topic = f"home/system/{device_id}/reboot"
     try:
-        app.state.mqtt_client.publish(topic, "")
+        _mqtt_send((topic, b""))
         return {"status": "reboot_command_sent", "device_id": device_id}
     except Exception as e:
-        logger.error(f"Failed to send reboot command: {e}")
+        logger.error("Failed to send reboot command: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/alerts/current")
-async def get_current_alerts() -> List[AlertItem]:
+@app.get("/api/alerts/current", response_model=List[AlertItem])
+async def get_current_alerts(limit: Optional[int] = None) -> Response:
     """Return the most recent instance of each (device_id, code) alert.
 
     This avoids accumulation; if a given device keeps sending the same code, we only keep the latest.
+    With `limit`, only the newest `limit` alerts are returned. Encoded bodies are reused until
+    record_alert next changes current_alerts.
     """
-    # Sort by last_seen descending for convenience
-    return sorted((item for item in current_alerts.values()), key=lambda x: x.last_seen, reverse=True)
+    global _alerts_bodies_version
+    if _alerts_bodies_version != _alerts_version:
+        _alerts_bodies.clear()
+        _alerts_bodies_version = _alerts_version
+    body = _alerts_bodies.get(limit)
+    if body is None:
+        # Each device's alerts are kept in recency order, so newest-first overall is a
+        # k-way merge of the reversed per-device dicts; the top N is its first N items
+        merged = heapq.merge(
+            *(reversed(device_alerts.values()) for device_alerts in current_alerts.values()),
+            key=attrgetter('last_seen'),
+            reverse=True,
+        )
+        newest = itertools.islice(merged, limit if limit is None else max(limit, 0))
+        body = _ALERTS_TA.dump_json(list(newest))
+        if len(_alerts_bodies) < _MAX_CACHED_ALERT_BODIES:
+            _alerts_bodies[limit] = body
+    return Response(content=body, media_type="application/json")
 
 # WebSocket endpoint for real-time updates
 @app.websocket("/ws/device-status")
 async def websocket_endpoint(websocket: WebSocket):
     await ws_manager.connect(websocket)
     try:
+        # Keepalive is protocol-level (uvicorn ws_ping_interval); inbound frames are
+        # only read so a close is noticed.
         while True:
-            data = await websocket.receive_text()
-            if data == "ping":
-                await websocket.send_json({"type": "pong"})
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                logger.info("WebSocket client disconnected")
+                break
     except WebSocketDisconnect:
         logger.info("WebSocket client disconnected")
     except Exception as e:
-        logger.error(f"WebSocket error: {e}")
+        logger.error("WebSocket error: %s", e)
     finally:
         ws_manager.disconnect(websocket)
 
+def _parse_iso_utc(value: str) -> datetime:
+    """Parse an ISO 8601 query parameter (UTC) into a naive datetime.
+
+    Uses the C-implemented datetime.fromisoformat (3.11+ accepts a trailing 'Z');
+    any offset is dropped rather than converted.
+    """
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+# '24h', '7d', ... accepted by the history endpoint's `range` parameter
+_RANGE_RE = re.compile(r"(\d+)([mhdw])")
+_UNIT_SECONDS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+_HISTORY_SERIES = ("temperature_f", "pressure_inhg")
+
+def _lttb(rows: List[dict], threshold: int) -> List[dict]:
+    """Downsample history rows to `threshold` points with Largest-Triangle-Three-Buckets.
+
+    Buckets are evenly spaced, so the row index serves as x. Both series are scaled to
+    their own range and their triangle areas summed, so neither dominates the choice;
+    a missing (None) value contributes no area.
+    """
+    n = len(rows)
+    if threshold >= n or threshold < 3:
+        return rows
+
+    series = []
+    for key in _HISTORY_SERIES:
+        values = [row[key] for row in rows]
+        present = [v for v in values if v is not None]
+        span = (max(present) - min(present)) if present else 0.0
+        if span:
+            series.append([v / span if v is not None else None for v in values])
+
+    every = (n - 2) / (threshold - 2)
+    out = [rows[0]]
+    a = 0
+    for i in range(threshold - 2):
+        # Average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        cx = (avg_start + avg_end - 1) / 2
+        cys = []
+        for ys in series:
+            window = [v for v in ys[avg_start:avg_end] if v is not None]
+            cys.append(sum(window) / len(window) if window else None)
+
+        # Point in this bucket forming the largest triangle with the last pick and that average
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        pick, best = range_start, -1.0
+        for j in range(range_start, range_end):
+            area = 0.0
+            for ys, cy in zip(series, cys):
+                ay, by = ys[a], ys[j]
+                if ay is not None and by is not None and cy is not None:
+                    area += abs((a - cx) * (by - ay) - (a - j) * (cy - ay))
+            if area > best:
+                pick, best = j, area
+        out.append(rows[pick])
+        a = pick
+    out.append(rows[-1])
+    return out
+
+# Upper bound accepted for the history endpoint's max_points
+HISTORY_MAX_POINTS = 10000
+
+# Browser/proxy cache lifetime per bucket size; only the newest bucket is still changing
+_HISTORY_MAX_AGE = {'minute': 60, 'hour': 600, 'day': 3600}
+
 @app.get("/api/garage/weather/history")
 async def get_garage_weather_history(
+    request: Request,
     start: Optional[str] = None,
     end: Optional[str] = None,
     range: Optional[str] = None,
     bucket: str = "hour",
-    session=Depends(get_session),
+    # LTTB keeps both endpoints, so fewer than 3 points cannot be honoured
+    max_points: Optional[int] = Query(None, ge=3, le=HISTORY_MAX_POINTS),
 ):
     """Return historical weather readings aggregated by time bucket.
 
@@ -1283,6 +1974,7 @@ async def get_garage_weather_history(
         end (str | None): ISO8601 end time (UTC). Defaults to now.
         range (str | None): Convenience like '24h', '7d', '30d'. Ignored when start provided.
         bucket (str): 'minute' | 'hour' | 'day'. Defaults to 'hour'.
+        max_points (int | None): If set (3..HISTORY_MAX_POINTS), downsample to at most this many points (LTTB).
 
     Returns:
         list[dict]: [{ ts, temperature_f, pressure_inhg }]
@@ -1290,33 +1982,38 @@ async def get_garage_weather_history(
     try:
         now = datetime.utcnow()
         # Parse end
-        end_dt = dateutil_parser.isoparse(end).replace(tzinfo=None) if end else now
+        end_dt = _parse_iso_utc(end) if end else now
         # Determine start
         if start:
-            start_dt = dateutil_parser.isoparse(start).replace(tzinfo=None)
+            start_dt = _parse_iso_utc(start)
         else:
             # Parse range like '24h', '7d', default 24h
             amount = 24
             unit = 'h'
             if range:
-                try:
-                    import re
-                    m = re.fullmatch(r"(\d+)([mhdw])", range.strip().lower())
-                    if m:
-                        amount = int(m.group(1))
-                        unit = m.group(2)
-                except Exception:
-                    pass
-            from datetime import timedelta
-            mult = { 'm': timedelta(minutes=1), 'h': timedelta(hours=1), 'd': timedelta(days=1), 'w': timedelta(weeks=1) }[unit]
-            start_dt = end_dt - amount * mult
-
-        data = await get_weather_history(session, start=start_dt, end=end_dt, bucket=bucket)
-        return data
+                m = _RANGE_RE.fullmatch(range.strip().lower())
+                if m:
+                    amount = int(m.group(1))
+                    unit = m.group(2)
+            start_dt = end_dt - timedelta(seconds=amount * _UNIT_SECONDS[unit])
+
+        async with app.state.pg.acquire() as conn:
+            data = await get_weather_history(conn, start=start_dt, end=end_dt, bucket=bucket)
+        cache_control = f"public, max-age={_HISTORY_MAX_AGE.get(bucket, 600)}"
+        if max_points is not None:
+            data = _lttb(data, max_points)
+        body = orjson.dumps(data)
+        # Hash the body: with a rolling end=now the query window differs on every call,
+        # but the buckets (and so the response) only change as new readings land
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"weather history failed: {e}")
+        logger.error("weather history failed: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
@@ -1342,9 +2039,12 @@ async def get_device_logs_endpoint(
     component: Optional[str] = None,
     limit: int = 100,
     session=Depends(get_session),
-):
+) -> Response:
     """Get device logs with optional filtering.
 
+    Rows are encoded with orjson in one pass; the response model documents the shape
+    but is not re-validated per row.
+
     Args:
         device_id (str): Device ID to get logs for
         start (str | None): ISO8601 start time filter
@@ -1364,12 +2064,12 @@ async def get_device_logs_endpoint(
     end_dt = None
     if start:
         try:
-            start_dt = dateutil_parser.isoparse(start).replace(tzinfo=None)
+            start_dt = _parse_iso_utc(start)
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid start datetime format")
     if end:
         try:
-            end_dt = dateutil_parser.isoparse(end).replace(tzinfo=None)
+            end_dt = _parse_iso_utc(end)
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid end datetime format")
     
@@ -1383,23 +2083,10 @@ async def get_device_logs_endpoint(
             component=component,
             limit=limit,
         )
-        
-        return [
-            DeviceLogResponse(
-                id=log.id,
-                device_id=log.device_id,
-                level=log.level,
-                component=log.component,
-                message=log.message,
-                details=log.details,
-                device_timestamp=log.device_timestamp,
-                sequence=log.sequence,
-                created_at=log.created_at,
-            )
-            for log in logs
-        ]
+        # OPT_UTC_Z keeps created_at formatted as pydantic did ("...Z")
+        return Response(content=orjson.dumps(logs, option=orjson.OPT_UTC_Z), media_type="application/json")
     except Exception as e:
-        logger.error(f"Failed to get device logs for {device_id}: {e}")
+        logger.error("Failed to get device logs for %s: %s", device_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1408,7 +2095,7 @@ async def get_device_crash_logs_endpoint(
     device_id: str,
     hours_back: int = 24,
     session=Depends(get_session),
-):
+) -> Response:
     """Get logs that might indicate device crashes or issues.
 
     Args:
@@ -1427,23 +2114,10 @@ async def get_device_crash_logs_endpoint(
             device_id=device_id,
             hours_back=hours_back,
         )
-        
-        return [
-            DeviceLogResponse(
-                id=log.id,
-                device_id=log.device_id,
-                level=log.level,
-                component=log.component,
-                message=log.message,
-                details=log.details,
-                device_timestamp=log.device_timestamp,
-                sequence=log.sequence,
-                created_at=log.created_at,
-            )
-            for log in logs
-        ]
+        # Rows are already DeviceLogResponse-shaped dicts; encode directly, as the logs endpoint does
+        return Response(content=orjson.dumps(logs, option=orjson.OPT_UTC_Z), media_type="application/json")
     except Exception as e:
-        logger.error(f"Failed to get crash logs for {device_id}: {e}")
+        logger.error("Failed to get crash logs for %s: %s", device_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1452,6 +2126,14 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info"
+        # The file watcher restarts the server on every edit; only wanted in development.
+        # Single worker on purpose: device, alert and websocket state live in this process.
+        reload=os.getenv("DEV", "0") == "1",
+        log_level="info",
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_ping_interval=20,
+        ws_ping_timeout=20,
+        ws_per_message_deflate=True,
     )
@@ -5,12 +5,44 @@ from __future__ import annotations
 
 from typing import AsyncGenerator
 
+import asyncpg
+import orjson
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from .config import get_database_url
 
-# Create async engine
-engine = create_async_engine(get_database_url(), echo=False, future=True)
+# Create async engine. Sensor inserts repeat a handful of statement shapes, so
+# keep asyncpg's server-side prepared statements (and SQLAlchemy's adapter cache)
+# large enough that they are parsed once per connection rather than per message.
+STATEMENT_CACHE_SIZE = 512
+
+# Queries here are short OLTP statements; JIT compilation only adds planning latency
+SERVER_SETTINGS = {"jit": "off"}
+
+
+def _json_dumps(value) -> str:
+    # SQLAlchemy's asyncpg json/jsonb codecs encode the serializer's str result themselves
+    return orjson.dumps(value).decode()
+
+
+engine = create_async_engine(
+    get_database_url(),
+    echo=False,
+    future=True,
+    # Fixed-size pool: the MQTT writer holds one connection, API requests share the rest
+    pool_size=16,
+    max_overflow=0,
+    pool_pre_ping=False,
+    pool_recycle=1800,
+    # JSONB columns (log details, SOS details, tags) go through orjson instead of stdlib json
+    json_serializer=_json_dumps,
+    json_deserializer=orjson.loads,
+    connect_args={
+        "statement_cache_size": STATEMENT_CACHE_SIZE,
+        "prepared_statement_cache_size": STATEMENT_CACHE_SIZE,
+        "server_settings": SERVER_SETTINGS,
+    },
+)
 
 # Async session factory
 AsyncSessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
@@ -25,3 +57,25 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
     """
     async with AsyncSessionLocal() as session:  # type: ignore[call-arg]
         yield session
+
+
+async def create_pg_pool(min_size: int = 4, max_size: int = 16) -> asyncpg.Pool:
+    """
+    Create a raw asyncpg pool for hot read-only queries that do not need the ORM.
+
+    Args:
+        min_size (int): Connections opened up front.
+        max_size (int): Upper bound on pooled connections.
+
+    Returns:
+        asyncpg.Pool: The connection pool; close it on shutdown.
+    """
+    dsn = get_database_url().replace("postgresql+asyncpg://", "postgresql://", 1)
+    return await asyncpg.create_pool(
+        dsn,
+        min_size=min_size,
+        max_size=max_size,
+        max_inactive_connection_lifetime=600,
+        statement_cache_size=STATEMENT_CACHE_SIZE,
+        server_settings=SERVER_SETTINGS,
+    )
@@ -5,6 +5,7 @@ from __future__ import annotations
 
 from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import JSONB
 
 from .engine import engine
 from .models import Base
@@ -20,6 +21,57 @@ async def init_db(async_engine: AsyncEngine | None = None) -> None:
     eng = async_engine or engine
     async with eng.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips existing tables entirely, so add indexes introduced later
+        await conn.run_sync(_create_missing_indexes)
+        # ...and likewise never adds server defaults to columns of existing tables
+        await conn.run_sync(_apply_server_defaults)
+        # ...or change column types: convert json columns created before the switch to jsonb
+        await conn.run_sync(_convert_json_to_jsonb)
+
+
+def _create_missing_indexes(sync_conn) -> None:
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+def _apply_server_defaults(sync_conn) -> None:
+    preparer = sync_conn.dialect.identifier_preparer
+    # ALTER TABLE takes an ACCESS EXCLUSIVE lock, so only touch columns whose default differs
+    current = {
+        (table_name, column_name): column_default
+        for table_name, column_name, column_default in sync_conn.execute(text(
+            "SELECT table_name, column_name, column_default FROM information_schema.columns "
+            "WHERE table_schema = current_schema()"
+        ))
+    }
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            if column.server_default is None:
+                continue
+            default = str(column.server_default.arg.compile(dialect=sync_conn.dialect))
+            if current.get((table.name, column.name)) == default:
+                continue
+            sync_conn.execute(text(
+                f"ALTER TABLE {preparer.format_table(table)} "
+                f"ALTER COLUMN {preparer.format_column(column)} SET DEFAULT {default}"
+            ))
+
+
+def _convert_json_to_jsonb(sync_conn) -> None:
+    preparer = sync_conn.dialect.identifier_preparer
+    legacy = set(sync_conn.execute(text(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND data_type = 'json'"
+    )).tuples())
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            if isinstance(column.type, JSONB) and (table.name, column.name) in legacy:
+                name = preparer.format_column(column)
+                sync_conn.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ALTER COLUMN {name} TYPE jsonb USING {name}::jsonb"
+                ))
 
 
 async def db_health_check(async_engine: AsyncEngine | None = None) -> dict:
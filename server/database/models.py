@@ -16,8 +16,10 @@ from sqlalchemy import (
     Integer,
     String,
     Text,
-    JSON,
+    func,
+    text,
 )
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -25,12 +27,12 @@ class Base(DeclarativeBase):
     """Base declarative class."""
 
     created_at: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), default=lambda: datetime.utcnow(), nullable=False
+        DateTime(timezone=True), server_default=func.now(), nullable=False
     )
     updated_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
-        default=lambda: datetime.utcnow(),
-        onupdate=lambda: datetime.utcnow(),
+        server_default=func.now(),
+        onupdate=func.now(),
         nullable=False,
     )
 
@@ -84,7 +86,7 @@ class DeviceBoot(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     device_id: Mapped[str] = mapped_column(String(64), ForeignKey("devices.device_id", ondelete="CASCADE"), nullable=False)
-    boot_time: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.utcnow(), nullable=False)
+    boot_time: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     reason: Mapped[Optional[str]] = mapped_column(String(64))
     success: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
     version: Mapped[Optional[str]] = mapped_column(String(64))
@@ -107,7 +109,7 @@ class SOSIncident(Base):
         device_id (str): FK to `devices.device_id`.
         status (str): 'open' or 'resolved'.
         error_message (str): Short message.
-        details (JSON): Enhanced details payload from device.
+        details (JSONB): Enhanced details payload from device.
         resolved_at (datetime): When resolved.
         resolved_by (str): Who resolved it.
         resolution_notes (str): Notes about fix.
@@ -119,7 +121,7 @@ class SOSIncident(Base):
     device_id: Mapped[str] = mapped_column(String(64), ForeignKey("devices.device_id", ondelete="SET NULL"))
     status: Mapped[str] = mapped_column(String(16), default="open", nullable=False)
     error_message: Mapped[Optional[str]] = mapped_column(Text)
-    details: Mapped[Optional[dict]] = mapped_column(JSON)
+    details: Mapped[Optional[dict]] = mapped_column(JSONB)
     resolved_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
     resolved_by: Mapped[Optional[str]] = mapped_column(String(64))
     resolution_notes: Mapped[Optional[str]] = mapped_column(Text)
@@ -143,7 +145,7 @@ class SensorReading(Base):
         value_float (float): Numeric value if applicable.
         value_text (str): Text value for categorical metrics (e.g., door states).
         recorded_at (datetime): Timestamp of the reading.
-        tags (JSON): Optional extra structured data.
+        tags (JSONB): Optional extra structured data.
     """
 
     __tablename__ = "sensor_readings"
@@ -153,11 +155,19 @@ class SensorReading(Base):
     metric: Mapped[str] = mapped_column(String(64), nullable=False)
     value_float: Mapped[Optional[float]] = mapped_column(Float)
     value_text: Mapped[Optional[str]] = mapped_column(String(64))
-    recorded_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.utcnow(), nullable=False)
-    tags: Mapped[Optional[dict]] = mapped_column(JSON)
+    recorded_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    tags: Mapped[Optional[dict]] = mapped_column(JSONB)
 
     __table_args__ = (
         Index("ix_sensor_device_metric_time", "device_id", "metric", "recorded_at"),
+        # Covering index for weather history bucketing: an index-only scan over the
+        # weather metrics instead of reading every sensor_readings heap row in range.
+        Index(
+            "ix_sensor_weather_time",
+            "recorded_at",
+            postgresql_where=text("metric IN ('weather_temperature_f', 'weather_pressure_inhg')"),
+            postgresql_include=["metric", "value_float"],
+        ),
     )
 
 
@@ -171,7 +181,7 @@ class DeviceLog(Base):
         level (str): Log level (DEBUG, INFO, WARNING, ERROR, CRITICAL).
         component (str): Component that generated the log (bootstrap, app, wifi, mqtt, sensors).
         message (str): Log message.
-        details (JSON): Additional structured data (stack trace, system stats, etc.).
+        details (JSONB): Additional structured data (stack trace, system stats, etc.).
         device_timestamp (int): Device-local timestamp in ms (ticks_ms).
         sequence (int): Sequence number for ordering logs from same device.
     """
@@ -183,7 +193,7 @@ class DeviceLog(Base):
     level: Mapped[str] = mapped_column(String(16), nullable=False)  # DEBUG, INFO, WARNING, ERROR, CRITICAL
     component: Mapped[str] = mapped_column(String(32), nullable=False)  # bootstrap, app, wifi, mqtt, sensors, etc.
     message: Mapped[str] = mapped_column(Text, nullable=False)
-    details: Mapped[Optional[dict]] = mapped_column(JSON)
+    details: Mapped[Optional[dict]] = mapped_column(JSONB)
     device_timestamp: Mapped[Optional[int]] = mapped_column(Integer)  # Device ticks_ms for correlation
     sequence: Mapped[Optional[int]] = mapped_column(Integer)  # Sequence number from device
 
@@ -192,6 +202,22 @@ class DeviceLog(Base):
         Index("ix_device_logs_device_time", "device_id", "created_at"),
         Index("ix_device_logs_level_time", "level", "created_at"),
         Index("ix_device_logs_component", "component", "created_at"),
+        # Device + level filter of get_device_logs, newest first; component rides along for its filter.
+        # message is deliberately not INCLUDEd: long texts would exceed the btree row size limit.
+        Index(
+            "ix_device_logs_device_level_time",
+            "device_id",
+            "level",
+            "created_at",
+            postgresql_include=["component"],
+        ),
+        # get_device_crash_logs: a device's newest ERROR/CRITICAL rows, read straight off the index
+        Index(
+            "ix_device_logs_errors",
+            "device_id",
+            "created_at",
+            postgresql_where=text("level IN ('ERROR', 'CRITICAL')"),
+        ),
     )
 
 
@@ -203,7 +229,7 @@ class SystemEvent(Base):
         id (int): Auto-increment primary key.
         type (str): Event type key.
         message (str): Human-readable message.
-        meta (JSON): Additional structured data.
+        meta (JSONB): Additional structured data.
     """
 
     __tablename__ = "system_events"
@@ -212,4 +238,4 @@ class SystemEvent(Base):
     type: Mapped[str] = mapped_column(String(64), nullable=False)
     message: Mapped[Optional[str]] = mapped_column(Text)
     # 'metadata' is reserved by SQLAlchemy Declarative; use attribute 'meta' and keep column name 'metadata'
-    meta: Mapped[Optional[dict]] = mapped_column("metadata", JSON)
+    meta: Mapped[Optional[dict]] = mapped_column("metadata", JSONB)
@@ -3,11 +3,15 @@ Repository helpers for common database operations.
 """
 from __future__ import annotations
 
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import Optional, TypedDict
 
-from sqlalchemy import select, update, text
+import asyncpg
+from sqlalchemy import func, lambda_stmt, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload, selectinload
+from sqlalchemy.sql.lambdas import StatementLambdaElement
 
 from .models import Device, DeviceBoot, SensorReading, SOSIncident, DeviceLog
 
@@ -41,37 +45,26 @@ async def upsert_device(
     Returns:
         Device: The persisted device row.
     """
-    result = await session.execute(select(Device).where(Device.device_id == device_id))
-    dev = result.scalar_one_or_none()
-    now = datetime.utcnow()
-    if dev is None:
-        dev = Device(
-            device_id=device_id,
-            status=status,
-            last_seen=last_seen or now,
-            version=version,
-            last_error=last_error,
-            last_boot=last_boot,
-            ip_address=ip_address,
-            rssi=rssi,
-        )
-        session.add(dev)
-    else:
-        if status is not None:
-            dev.status = status
-        dev.last_seen = last_seen or now
-        if version is not None:
-            dev.version = version
-        if last_error is not None:
-            dev.last_error = last_error
-        if last_boot is not None:
-            dev.last_boot = last_boot
-        if ip_address is not None:
-            dev.ip_address = ip_address
-        if rssi is not None:
-            dev.rssi = rssi
+    # Fields left as None keep their stored value on update; last_seen is always refreshed
+    fields = {
+        "status": status,
+        "version": version,
+        "last_error": last_error,
+        "last_boot": last_boot,
+        "ip_address": ip_address,
+        "rssi": rssi,
+    }
+    provided = {key: value for key, value in fields.items() if value is not None}
+    provided["last_seen"] = last_seen or func.now()
+    # One atomic round-trip instead of SELECT then INSERT/UPDATE (and refresh)
+    stmt = pg_insert(Device).values(device_id=device_id, **provided)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Device.device_id],
+        set_={**{key: stmt.excluded[key] for key in provided}, "updated_at": func.now()},
+    ).returning(Device)
+    result = await session.execute(stmt, execution_options={"populate_existing": True})
+    dev = result.scalar_one()
     await session.commit()
-    await session.refresh(dev)
     return dev
 
 
@@ -89,7 +82,7 @@ async def log_device_boot(
     """Insert a device boot log entry."""
     entry = DeviceBoot(
         device_id=device_id,
-        boot_time=boot_time or datetime.utcnow(),
+        boot_time=boot_time,
         reason=reason,
         success=success,
         version=version,
@@ -102,29 +95,118 @@ async def log_device_boot(
     return entry
 
 
-async def record_sensor_reading(
-    session: AsyncSession,
-    *,
-    device_id: Optional[str],
-    metric: str,
-    value_float: Optional[float] = None,
-    value_text: Optional[str] = None,
-    recorded_at: Optional[datetime] = None,
-    tags: Optional[dict] = None,
-) -> SensorReading:
-    """Insert a sensor reading."""
-    row = SensorReading(
-        device_id=device_id,
-        metric=metric,
-        value_float=value_float,
-        value_text=value_text,
-        recorded_at=recorded_at or datetime.utcnow(),
-        tags=tags,
+async def get_devices_with_history(session: AsyncSession, *, hours: int) -> list[Device]:
+    """
+    Load all devices with their recent boots and open SOS incidents.
+
+    Both collections are fetched with selectinload (one IN query each, three in total),
+    so iterating them never lazy-loads; any other relationship access raises.
+
+    Args:
+        session (AsyncSession): DB session
+        hours (int): How far back to include boots
+
+    Returns:
+        list[Device]: Devices with `boots` and `sos_incidents` populated.
+    """
+    cutoff = func.now() - timedelta(hours=hours)
+    query = select(Device).options(
+        selectinload(Device.boots.and_(DeviceBoot.boot_time >= cutoff)),
+        selectinload(Device.sos_incidents.and_(SOSIncident.status == "open")),
+        raiseload("*"),
     )
-    session.add(row)
+    result = await session.execute(query)
+    return list(result.scalars().all())
+
+
+# Column order of the records accepted by record_sensor_readings / record_device_logs.
+# created_at/updated_at are supplied by the caller so they carry the receive time, not the flush time.
+SENSOR_READING_COPY_COLUMNS = (
+    "device_id", "metric", "value_float", "value_text", "recorded_at", "created_at", "updated_at",
+)
+DEVICE_LOG_COPY_COLUMNS = (
+    "device_id", "level", "component", "message", "details", "device_timestamp", "sequence",
+    "created_at", "updated_at",
+)
+
+
+# Errors a single bad row can raise from COPY: a server-side rejection (FK miss, CHECK,
+# value too long) or asyncpg's client-side encode error, which is a ValueError
+_COPY_ROW_ERRORS = (asyncpg.PostgresError, ValueError)
+
+
+async def _copy_and_commit(session: AsyncSession, table: str, records: list[tuple], columns: tuple[str, ...]) -> None:
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    await session.execute(text("SET LOCAL synchronous_commit TO OFF"))
+    await raw.driver_connection.copy_records_to_table(table, records=records, columns=columns)
     await session.commit()
-    await session.refresh(row)
-    return row
+
+
+async def _copy_records(
+    session: AsyncSession, table: str, records: list[tuple], columns: tuple[str, ...]
+) -> list[tuple]:
+    """
+    Bulk-insert rows with Postgres binary COPY and commit.
+
+    Runs in the session's transaction on its asyncpg connection, with synchronous_commit
+    off for just this transaction: callers pass high-volume telemetry, so losing the last
+    few milliseconds on a server crash is acceptable in exchange for not waiting on WAL flush.
+
+    One row the table rejects fails the whole COPY. The rows are then retried one per
+    transaction, so only the bad rows are lost.
+
+    Returns:
+        list[tuple]: The rejected records (empty when the batch went in whole).
+    """
+    if not records:
+        return []
+    try:
+        await _copy_and_commit(session, table, records, columns)
+        return []
+    except _COPY_ROW_ERRORS:
+        await session.rollback()
+        if len(records) == 1:
+            return list(records)
+    rejected = []
+    for record in records:
+        try:
+            await _copy_and_commit(session, table, [record], columns)
+        except _COPY_ROW_ERRORS:
+            await session.rollback()
+            rejected.append(record)
+    return rejected
+
+
+async def record_sensor_readings(session: AsyncSession, records: list[tuple]) -> list[tuple]:
+    """
+    Bulk-insert sensor readings with binary COPY (see _copy_records).
+
+    Args:
+        session (AsyncSession): DB session.
+        records (list[tuple]): Rows in SENSOR_READING_COPY_COLUMNS order.
+
+    Returns:
+        list[tuple]: Records the table rejected.
+    """
+    return await _copy_records(session, SensorReading.__tablename__, records, SENSOR_READING_COPY_COLUMNS)
+
+
+async def record_device_logs(session: AsyncSession, records: list[tuple]) -> list[tuple]:
+    """
+    Bulk-insert device logs with binary COPY (see _copy_records).
+
+    Records should already satisfy the device_logs constraints (known level, integer
+    ranges, existing device); a row that does not is dropped on its own.
+
+    Args:
+        session (AsyncSession): DB session.
+        records (list[tuple]): Rows in DEVICE_LOG_COPY_COLUMNS order; details as a JSON string.
+
+    Returns:
+        list[tuple]: Records the table rejected.
+    """
+    return await _copy_records(session, DeviceLog.__tablename__, records, DEVICE_LOG_COPY_COLUMNS)
 
 
 async def create_sos_incident(
@@ -154,22 +236,44 @@ async def resolve_sos_incident(
     resolved_by: Optional[str] = None,
     resolution_notes: Optional[str] = None,
 ) -> Optional[SOSIncident]:
-    """Mark an SOS incident as resolved."""
-    result = await session.execute(select(SOSIncident).where(SOSIncident.id == incident_id))
+    """Mark an SOS incident as resolved; returns None if it does not exist."""
+    stmt = (
+        update(SOSIncident)
+        .where(SOSIncident.id == incident_id)
+        .values(
+            status="resolved",
+            resolved_at=func.now(),
+            resolved_by=resolved_by,
+            resolution_notes=resolution_notes,
+        )
+        .returning(SOSIncident)
+    )
+    result = await session.execute(stmt, execution_options={"populate_existing": True})
     incident = result.scalar_one_or_none()
-    if not incident:
-        return None
-    incident.status = "resolved"
-    incident.resolved_at = datetime.utcnow()
-    incident.resolved_by = resolved_by
-    incident.resolution_notes = resolution_notes
     await session.commit()
-    await session.refresh(incident)
     return incident
 
 
+# asyncpg-native ($n parameters): weather history is read through the raw pool, not a session
+# Rows come back JSON-ready: ts is formatted in SQL exactly as datetime.isoformat() rendered
+# the UTC bucket, and AVG over a double column is already a float or NULL. The fixed-width
+# ts text sorts chronologically.
+_WEATHER_HISTORY_SQL = """
+    SELECT
+        to_char(date_trunc($1, recorded_at) AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"+00:00"') AS ts,
+        AVG(value_float) FILTER (WHERE metric = 'weather_temperature_f') AS temperature_f,
+        AVG(value_float) FILTER (WHERE metric = 'weather_pressure_inhg') AS pressure_inhg
+    FROM sensor_readings
+    WHERE metric IN ('weather_temperature_f', 'weather_pressure_inhg')
+      AND recorded_at >= $2
+      AND recorded_at < $3
+    GROUP BY 1
+    ORDER BY 1 ASC
+"""
+
+
 async def get_weather_history(
-    session: AsyncSession,
+    conn: asyncpg.Connection,
     *,
     start: datetime,
     end: datetime,
@@ -179,7 +283,7 @@ async def get_weather_history(
     Return aggregated weather history between start and end, bucketed by the given granularity.
 
     Args:
-        session (AsyncSession): DB session.
+        conn (asyncpg.Connection): Connection acquired from the raw pool (see create_pg_pool).
         start (datetime): Inclusive start time (UTC).
         end (datetime): Exclusive end time (UTC).
         bucket (str): One of 'minute', 'hour', 'day'. Defaults to 'hour'.
@@ -192,75 +296,35 @@ async def get_weather_history(
         bucket = "hour"
 
     # Use a single SQL to compute both series aligned by bucket for efficiency
-    sql = text(
-        """
-        SELECT
-            date_trunc(:bucket, recorded_at) AS ts,
-            AVG(value_float) FILTER (WHERE metric = 'weather_temperature_f') AS temperature_f,
-            AVG(value_float) FILTER (WHERE metric = 'weather_pressure_inhg') AS pressure_inhg
-        FROM sensor_readings
-        WHERE metric IN ('weather_temperature_f', 'weather_pressure_inhg')
-          AND recorded_at >= :start
-          AND recorded_at < :end
-        GROUP BY ts
-        ORDER BY ts ASC
-        """
-    )
-    result = await session.execute(sql, {"bucket": bucket, "start": start, "end": end})
-    rows = []
-    for ts, temperature_f, pressure_inhg in result.fetchall():
-        # Normalize to ISO 8601 without timezone info for client-side
-        try:
-            ts_iso = ts.isoformat()
-        except Exception:
-            ts_iso = str(ts)
-        rows.append({
-            "ts": ts_iso,
-            "temperature_f": float(temperature_f) if temperature_f is not None else None,
-            "pressure_inhg": float(pressure_inhg) if pressure_inhg is not None else None,
-        })
-    return rows
-
-
-async def create_device_log(
-    session: AsyncSession,
-    *,
-    device_id: str,
-    level: str,
-    component: str,
-    message: str,
-    details: Optional[dict] = None,
-    device_timestamp: Optional[int] = None,
-    sequence: Optional[int] = None,
-) -> DeviceLog:
-    """Insert a device log entry for debugging and crash analysis.
-    
-    Args:
-        session (AsyncSession): DB session
-        device_id (str): Device ID
-        level (str): Log level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-        component (str): Component that generated the log
-        message (str): Log message
-        details (Optional[dict]): Additional structured data
-        device_timestamp (Optional[int]): Device-local timestamp in ms
-        sequence (Optional[int]): Sequence number from device
-        
-    Returns:
-        DeviceLog: The persisted log entry
-    """
-    log_entry = DeviceLog(
-        device_id=device_id,
-        level=level.upper(),
-        component=component,
-        message=message,
-        details=details,
-        device_timestamp=device_timestamp,
-        sequence=sequence,
-    )
-    session.add(log_entry)
-    await session.commit()
-    await session.refresh(log_entry)
-    return log_entry
+    return [dict(record) for record in await conn.fetch(_WEATHER_HISTORY_SQL, bucket, start, end)]
+
+
+class DeviceLogRow(TypedDict):
+    """A device_logs row as returned by the log read helpers (DEVICE_LOG_COLUMNS)."""
+
+    id: int
+    device_id: str
+    level: str
+    component: str
+    message: str
+    details: Optional[dict]
+    device_timestamp: Optional[int]
+    sequence: Optional[int]
+    created_at: datetime
+
+
+# Columns selected by the log read helpers; plain rows skip ORM identity-map and instance setup
+DEVICE_LOG_COLUMNS = (
+    DeviceLog.id,
+    DeviceLog.device_id,
+    DeviceLog.level,
+    DeviceLog.component,
+    DeviceLog.message,
+    DeviceLog.details,
+    DeviceLog.device_timestamp,
+    DeviceLog.sequence,
+    DeviceLog.created_at,
+)
 
 
 async def get_device_logs(
@@ -272,7 +336,7 @@ async def get_device_logs(
     level: Optional[str] = None,
     component: Optional[str] = None,
     limit: int = 100,
-) -> list[DeviceLog]:
+) -> list[DeviceLogRow]:
     """Retrieve device logs with optional filtering.
     
     Args:
@@ -285,23 +349,32 @@ async def get_device_logs(
         limit (int): Maximum number of logs to return
         
     Returns:
-        list[DeviceLog]: List of matching log entries ordered by creation time desc
+        list[DeviceLogRow]: Matching log entries ordered by creation time desc
     """
-    query = select(DeviceLog).where(DeviceLog.device_id == device_id)
-    
+    query = _device_logs_stmt(device_id, start, end, level, component, limit)
+    result = await session.execute(query)
+    return [dict(row) for row in result.mappings()]  # type: ignore[misc]
+
+
+def _device_logs_stmt(device_id, start, end, level, component, limit) -> StatementLambdaElement:
+    """
+    Build the get_device_logs query, newest first, as a lambda statement.
+
+    Each lambda is analyzed once; later calls only pull the closure values out as bound
+    parameters, and the compiled SQL is cached per combination of filters applied.
+    """
+    stmt = lambda_stmt(lambda: select(*DEVICE_LOG_COLUMNS).where(DeviceLog.device_id == device_id))
     if start:
-        query = query.where(DeviceLog.created_at >= start)
+        stmt += lambda s: s.where(DeviceLog.created_at >= start)
     if end:
-        query = query.where(DeviceLog.created_at <= end)
+        stmt += lambda s: s.where(DeviceLog.created_at <= end)
     if level:
-        query = query.where(DeviceLog.level == level.upper())
+        level = level.upper()
+        stmt += lambda s: s.where(DeviceLog.level == level)
     if component:
-        query = query.where(DeviceLog.component == component)
-        
-    query = query.order_by(DeviceLog.created_at.desc()).limit(limit)
-    
-    result = await session.execute(query)
-    return list(result.scalars().all())
+        stmt += lambda s: s.where(DeviceLog.component == component)
+    stmt += lambda s: s.order_by(DeviceLog.created_at.desc()).limit(limit)
+    return stmt
 
 
 async def get_device_crash_logs(
@@ -309,7 +382,7 @@ async def get_device_crash_logs(
     *,
     device_id: str,
     hours_back: int = 24,
-) -> list[DeviceLog]:
+) -> list[DeviceLogRow]:
     """Get logs that might indicate device crashes or issues.
     
     Args:
@@ -318,16 +391,17 @@ async def get_device_crash_logs(
         hours_back (int): Hours to look back from now
         
     Returns:
-        list[DeviceLog]: Error and critical logs that might indicate crashes
+        list[DeviceLogRow]: Error and critical logs that might indicate crashes
     """
-    from datetime import timedelta
-    start_time = datetime.utcnow() - timedelta(hours=hours_back)
-    
-    query = select(DeviceLog).where(
+    # Cutoff is computed by Postgres, on the same clock that stamped created_at. The level
+    # test is literal SQL so it provably matches ix_device_logs_errors' predicate even under
+    # a generic plan; an expanding IN would send the levels as bound parameters.
+    # Not a lambda_stmt: a closure timedelta there is bound as TIMESTAMP, not INTERVAL.
+    query = select(*DEVICE_LOG_COLUMNS).where(
         DeviceLog.device_id == device_id,
-        DeviceLog.created_at >= start_time,
-        DeviceLog.level.in_(['ERROR', 'CRITICAL'])
+        DeviceLog.created_at >= func.now() - timedelta(hours=hours_back),
+        text("device_logs.level IN ('ERROR', 'CRITICAL')"),
     ).order_by(DeviceLog.created_at.desc()).limit(50)
     
     result = await session.execute(query)
-    return list(result.scalars().all())
+    return [dict(row) for row in result.mappings()]  # type: ignore[misc]